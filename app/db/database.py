@@ -15,5 +15,17 @@ def create_connection():
         db.close()
 
 
+def run_with_session(func, *args):
+    """
+        Runs func(db, *args) with a new Session, used by jobs and code outside of request dependencies.
+    """
+    session = sessionmaker(autocommit=False, bind=init_db.engine)
+    db = session()
+    try:
+        return func(db, *args)
+    finally:
+        db.close()
+
+
 def get_database(session):
     return
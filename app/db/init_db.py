@@ -4,3 +4,27 @@ from sqlalchemy import create_engine
 database_url = f"postgresql://{settings.DB_USERNAME}:{settings.DB_PASSWORD}" \
                f"@{settings.DB_HOST}:{settings.DB_PORT}/{settings.DB_NAME}"
 engine = create_engine(database_url)  # creates database engine from given environment variables
+
+
+def create_tables():
+    """
+        Creates the missing tables and applies the pending schema migrations.
+    """
+    from app.db.base import Base
+    from app.db.migrations import migrate, ensure_trigram_index
+    import app.models  # registers the models on Base
+    with engine.connect() as connection:
+        migrate(connection, Base.metadata)
+        # without pg_trgm every trigram search would fail, the prefix search is used instead
+        if settings.PROFILE_SEARCH_TRIGRAM and not ensure_trigram_index(connection):
+            print('PROFILE_SEARCH_TRIGRAM is turned off, the trigram index can not be created')
+            settings.PROFILE_SEARCH_TRIGRAM = False
+
+
+def fill_missing_data():
+    """
+        Fills the data of older rows which migrations leave to batches, the feed works without it meanwhile.
+    """
+    from app.db.migrations import fill_post_vectors
+    with engine.connect() as connection:
+        fill_post_vectors(connection)
@@ -0,0 +1,170 @@
+from contextlib import contextmanager
+
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+
+from app.miscFunctions.names import normalize_name
+
+# Tables missing entirely are created from the models, the migrations bring tables created by an older
+# version up to date. A database created from the current models has to be left unchanged by every migration,
+# so the statements use IF NOT EXISTS or check the catalog first.
+
+# arbitrary key of the advisory lock, the workers of one deployment start at the same time
+MIGRATION_LOCK = 7212022
+TRIGRAM_INDEX = 'users_search_name_trgm_idx'
+
+
+def _add_unique(table: str, name: str, *columns: str):
+    def add(connection):
+        exists = connection.execute(
+            text('SELECT 1 FROM pg_constraint WHERE conname = :name AND conrelid = CAST(:table AS regclass)'),
+            {'name': name, 'table': table}).first()
+        if exists is None:
+            # fails on duplicate rows, they have to be resolved by hand before the upgrade
+            connection.exec_driver_sql(f'ALTER TABLE {table} ADD CONSTRAINT {name} UNIQUE ({", ".join(columns)})')
+    return add
+
+
+def _fill_search_names(connection):
+    users = connection.execute(text('SELECT id, first_name, last_name FROM users WHERE search_name IS NULL')).all()
+    if users:
+        connection.execute(
+            text('UPDATE users SET search_name = :search_name, search_name_reverse = :search_name_reverse '
+                 'WHERE id = :id'),
+            [{'id': user.id,
+              'search_name': normalize_name(user.first_name, user.last_name),
+              'search_name_reverse': normalize_name(user.last_name, user.first_name)} for user in users])
+
+
+def _add_trigram_index(connection):
+    try:
+        with connection.begin_nested():
+            connection.exec_driver_sql('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+            connection.exec_driver_sql(f'CREATE INDEX IF NOT EXISTS {TRIGRAM_INDEX} '
+                                       'ON users USING gin (search_name gin_trgm_ops)')
+    except DBAPIError as error:
+        print(f'Trigram profile search is not available, prefix search is used: {error.orig}')
+        return False
+    return True
+
+
+# (version, description, steps), a step is an SQL statement or a function of the connection,
+# a function returns False when it could not be applied and the migration is tried again on the next start
+MIGRATIONS = [
+    (1, 'columns and indexes added before the migrations', [
+        'ALTER TABLE users ADD COLUMN IF NOT EXISTS photo_mime VARCHAR(50)',
+        'ALTER TABLE users ADD COLUMN IF NOT EXISTS photo_hash VARCHAR(64)',
+        'ALTER TABLE post_photos ADD COLUMN IF NOT EXISTS mime VARCHAR(50)',
+        'ALTER TABLE post_photos ADD COLUMN IF NOT EXISTS hash VARCHAR(64)',
+        'ALTER TABLE posts ADD COLUMN IF NOT EXISTS unit_x DOUBLE PRECISION',
+        'ALTER TABLE posts ADD COLUMN IF NOT EXISTS unit_y DOUBLE PRECISION',
+        'ALTER TABLE posts ADD COLUMN IF NOT EXISTS unit_z DOUBLE PRECISION',
+        'CREATE INDEX IF NOT EXISTS posts_latitude_longitude_idx ON posts (latitude, longitude)',
+        'CREATE INDEX IF NOT EXISTS notification_outbox_next_attempt_idx ON notification_outbox (next_attempt)',
+    ]),
+    # the vectors are filled by fill_post_vectors in batches after the start, a single UPDATE would lock
+    # every post while all workers wait for the migration lock
+    (2, 'unit vectors of the posts created before they were stored', []),
+    (3, 'indexes of the feed, photo, farm and follower queries', [
+        'CREATE INDEX IF NOT EXISTS posts_date_id_idx ON posts (date, id)',
+        'CREATE INDEX IF NOT EXISTS posts_user_id_date_id_idx ON posts (user_id, date, id)',
+        'CREATE INDEX IF NOT EXISTS post_photos_post_id_idx ON post_photos (post_id)',
+        'CREATE INDEX IF NOT EXISTS interactions_followed_profile_follower_idx '
+        'ON interactions (followed_profile, follower)',
+        'CREATE INDEX IF NOT EXISTS farms_user_id_idx ON farms (user_id)',
+    ]),
+    (4, 'unique emails, settings and attributes per user', [
+        _add_unique('users', 'users_email_key', 'email'),
+        _add_unique('settings', 'settings_user_id_key', 'user_id'),
+        _add_unique('users_attributes', 'users_attributes_user_id_key', 'user_id'),
+    ]),
+    (5, 'normalized names of the profile search', [
+        'ALTER TABLE users ADD COLUMN IF NOT EXISTS search_name VARCHAR(101)',
+        'ALTER TABLE users ADD COLUMN IF NOT EXISTS search_name_reverse VARCHAR(101)',
+        _fill_search_names,
+        'CREATE INDEX IF NOT EXISTS users_search_name_idx ON users (search_name varchar_pattern_ops)',
+        'CREATE INDEX IF NOT EXISTS users_search_name_reverse_idx ON users (search_name_reverse varchar_pattern_ops)',
+    ]),
+    # optional, pg_trgm may not be installed or the database user may not be allowed to create it
+    (6, 'trigram index of the profile search', [_add_trigram_index]),
+    (7, 'upstream precision of the weather coordinates', [
+        'ALTER TABLE weather ALTER COLUMN coord_lat TYPE NUMERIC(8, 5), ALTER COLUMN coord_lon TYPE NUMERIC(9, 5)',
+    ]),
+    (8, 'long city names of the weather snapshots', [
+        'ALTER TABLE weather ALTER COLUMN name TYPE VARCHAR(255)',
+    ]),
+]
+
+
+def applied_versions(connection):
+    connection.exec_driver_sql(
+        'CREATE TABLE IF NOT EXISTS schema_version ('
+        'version INTEGER PRIMARY KEY, description TEXT NOT NULL, applied TIMESTAMP NOT NULL DEFAULT now())')
+    return {row.version for row in connection.execute(text('SELECT version FROM schema_version'))}
+
+
+@contextmanager
+def _migration_lock(connection):
+    # concurrent holders wait for each other, so only one of them changes the schema
+    connection.execute(text('SELECT pg_advisory_lock(:key)'), {'key': MIGRATION_LOCK})
+    try:
+        yield
+    finally:
+        connection.execute(text('SELECT pg_advisory_unlock(:key)'), {'key': MIGRATION_LOCK})
+
+
+def migrate(connection, metadata):
+    """
+        Creates the missing tables of metadata and applies the pending migrations in order.
+        Concurrent calls wait for each other, so only one of them changes the schema.
+    """
+    with _migration_lock(connection):
+        metadata.create_all(bind=connection)
+        with connection.begin():
+            applied = applied_versions(connection)
+        for version, description, steps in MIGRATIONS:
+            if version in applied:
+                continue
+            with connection.begin():
+                done = True
+                for step in steps:
+                    if not callable(step):
+                        connection.exec_driver_sql(step)
+                    elif step(connection) is False:
+                        done = False
+                if done:
+                    connection.execute(
+                        text('INSERT INTO schema_version (version, description) VALUES (:version, :description)'),
+                        {'version': version, 'description': description})
+            print(f'{"Applied" if done else "Could not apply"} migration {version}: {description}')
+
+
+def fill_post_vectors(connection, batch_size: int = 10000):
+    """
+        Computes the unit vectors of the posts created before they were stored, in ranges of ids
+        committed one by one, so only the posts of one batch are locked at a time.
+    """
+    with connection.begin():
+        first, last = connection.execute(text('SELECT min(id), max(id) FROM posts WHERE unit_x IS NULL')).one()
+    if first is None:
+        return
+    for start in range(first, last + 1, batch_size):
+        with connection.begin():
+            connection.execute(
+                text('UPDATE posts SET unit_x = cos(radians(latitude)) * cos(radians(longitude)), '
+                     'unit_y = cos(radians(latitude)) * sin(radians(longitude)), unit_z = sin(radians(latitude)) '
+                     'WHERE id >= :start AND id < :end AND unit_x IS NULL'),
+                {'start': start, 'end': start + batch_size})
+    print(f'Filled the unit vectors of the posts {first} to {last}')
+
+
+def ensure_trigram_index(connection):
+    """
+        Creates the trigram index of the profile search when it is missing, e.g. pg_trgm was installed
+        after migration 6 was tried. Returns False when the trigram search can not be used.
+    """
+    with _migration_lock(connection):
+        with connection.begin():
+            if connection.execute(text('SELECT to_regclass(:name)'), {'name': TRIGRAM_INDEX}).scalar():
+                return True
+            return _add_trigram_index(connection)
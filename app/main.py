@@ -7,7 +7,7 @@ from fastapi_amis_admin.admin.site import AdminSite
 from sqlalchemy.orm import Session
 
 from app.schemas.auth_schema import Token
-from .db.database import create_connection
+from .db.database import create_connection, run_with_session
 from .models import Users
 
 from .routers import login, register, weather, farms, profile, feed, settings
@@ -22,7 +22,15 @@ from firebase_admin import credentials
 
 from fastapi_scheduler import SchedulerAdmin
 
-from .routers.weather import get_alert
+from .routers.weather import get_alert, refresh_weather_store
+from .routers.feed import dispatch_news_outbox
+from starlette.concurrency import run_in_threadpool
+from .db.init_db import create_tables, fill_missing_data
+from .settings import settings as app_settings
+from .miscFunctions.http_client import close_clients
+from .miscFunctions.images import shutdown_variants
+from .miscFunctions.counters import flush_like_counts
+from .miscFunctions.upload_limit import UploadLimitMiddleware
 
 cred = credentials.Certificate('firebase_cred.json')
 firebase_admin.initialize_app(cred)
@@ -40,12 +48,15 @@ app = FastAPI()
         await asyncio.sleep(5)
 """
 
+# inside of CORSMiddleware, so the refused uploads carry its headers
+app.add_middleware(UploadLimitMiddleware, max_body_size=app_settings.UPLOAD_MAX_BODY_SIZE)
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
     allow_origins=["*"],
+    expose_headers=[feed.NEXT_CURSOR_HEADER],
 )
 
 app.include_router(login.router)
@@ -68,17 +79,44 @@ scheduler.timezone = get_localzone()
 
 
 @scheduler.scheduled_job('cron', hour=10, minute=10,)
-def interval_task():
+async def interval_task():
     # print("Interval task running...")
-    get_alert()
+    await get_alert()
+
+
+@scheduler.scheduled_job('interval', seconds=app_settings.WEATHER_REFRESH_INTERVAL)
+async def weather_refresh_task():
+    await refresh_weather_store()
+
+
+@scheduler.scheduled_job('interval', seconds=app_settings.OUTBOX_DISPATCH_INTERVAL)
+async def news_outbox_task():
+    # retries failed follower notifications and the ones left behind by a stopped worker
+    await run_in_threadpool(dispatch_news_outbox)
+
+
+@scheduler.scheduled_job('interval', seconds=app_settings.COUNTER_FLUSH_INTERVAL)
+async def like_count_flush_task():
+    # adds the like count changes collected in the shard rows to the profiles
+    if app_settings.COUNTER_SHARDS > 0:
+        await run_in_threadpool(run_with_session, flush_like_counts)
 
 
 @app.on_event("startup")
 async def startup():
+    create_tables()
+    # the workers start without waiting for the backfill
+    asyncio.get_running_loop().run_in_executor(None, fill_missing_data)
     site.mount_app(app)
     scheduler.start()
 
 
+@app.on_event("shutdown")
+async def shutdown():
+    await close_clients()
+    shutdown_variants()
+
+
 """@app.get('/me', summary='Get details of currently logged in user', response_model=Token)
 async def get_me(user: Users = Depends(get_current_user)):
     return user"""
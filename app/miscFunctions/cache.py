@@ -0,0 +1,206 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+        Bounded LRU cache with a time to live for every entry.
+        Expired entries are kept for stale_ttl more seconds, so get_stale can still serve them.
+        Keeps hit, miss and eviction counters, safe to use from threadpool workers.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, stale_ttl: float = 0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def _lookup(self, key, now):
+        # returns the entry, or None when it is missing or past its stale window
+        entry = self._data.get(key)
+        if entry is not None and entry[1] + self.stale_ttl <= now:
+            del self._data[key]
+            self.expirations += 1
+            entry = None
+        return entry
+
+    def get(self, key):
+        """
+            Returns the cached value or None if it is missing or expired.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._lookup(key, now)
+            if entry is None or entry[1] <= now:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def get_stale(self, key):
+        """
+            Returns (value, is_stale), expired values within the stale window are returned with is_stale True.
+            Returns (None, False) if the key is missing.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._lookup(key, now)
+            if entry is None:
+                self.misses += 1
+                return None, False
+            self._data.move_to_end(key)
+            if entry[1] <= now:
+                self.stale_hits += 1
+                return entry[0], True
+            self.hits += 1
+            return entry[0], False
+
+    def peek(self, key):
+        """
+            Returns the cached value like get, without touching the counters or the LRU order.
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[1] <= time.monotonic():
+                return None
+            return entry[0]
+
+    def put(self, key, value, ttl: float = None):
+        if self.maxsize <= 0:
+            return
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            if self._data.pop(key, None) is None:
+                return False
+            self.invalidations += 1
+            return True
+
+    def invalidate_where(self, predicate):
+        """
+            Removes every entry whose key matches predicate(key), returns the number of removed entries.
+        """
+        with self._lock:
+            keys = [key for key in self._data if predicate(key)]
+            for key in keys:
+                del self._data[key]
+            self.invalidations += len(keys)
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.stale_hits + self.misses
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'stale_hits': self.stale_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+            }
+
+
+class ByteLRUCache:
+    """
+        LRU cache of byte strings bounded by their total size instead of the number of entries.
+        Entries expire after ttl seconds, values larger than max_item_bytes are not cached.
+    """
+
+    def __init__(self, max_bytes: int, max_item_bytes: int, ttl: float):
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_item_bytes
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _remove(self, key):
+        entry = self._data.pop(key)
+        self.bytes -= len(entry[0])
+
+    def get(self, key):
+        """
+            Returns (content, info) stored with put, or None if it is missing or expired.
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[2] <= time.monotonic():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0], entry[1]
+
+    def put(self, key, content: bytes, info=None):
+        if len(content) > self.max_item_bytes or len(content) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (content, info, time.monotonic() + self.ttl)
+            self.bytes += len(content)
+            while self.bytes > self.max_bytes:
+                self._remove(next(iter(self._data)))
+                self.evictions += 1
+
+    def invalidate_where(self, predicate):
+        """
+            Removes every entry whose key matches predicate(key), returns the number of removed entries.
+        """
+        with self._lock:
+            keys = [key for key in self._data if predicate(key)]
+            for key in keys:
+                self._remove(key)
+            self.invalidations += len(keys)
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,64 @@
+import time
+
+
+class CircuitBreaker:
+    """
+        Stops calling a failing upstream. After failure_threshold consecutive failures the circuit opens
+        and calls are refused for reset_timeout seconds. Then a single probe call is let through
+        (half open), its success closes the circuit again and its failure opens it for another period.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.opened = 0
+        self.rejected = 0
+
+    def allow(self):
+        """
+            Returns True if a call may go upstream. In the half open state only one probe is allowed at a time.
+        """
+        if self.state == self.OPEN and time.monotonic() >= self.opened_at + self.reset_timeout:
+            self.state = self.HALF_OPEN
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.HALF_OPEN and not self.probing:
+            self.probing = True
+            return True
+        self.rejected += 1
+        return False
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self.probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                self.opened += 1
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+        self.probing = False
+
+    def release(self):
+        """
+            Frees the probe slot of a call which ended without a result, e.g. when it was cancelled.
+        """
+        self.probing = False
+
+    def stats(self):
+        return {
+            'state': self.state,
+            'failures': self.failures,
+            'opened': self.opened,
+            'rejected': self.rejected,
+        }
@@ -1,3 +1,5 @@
+import math
+
 from fastapi import HTTPException
 from starlette import status
 
@@ -14,3 +16,63 @@ def check_coors(long: float, lat: float):
             detail=f"Latitude out of bounds."
         )
     return
+
+
+def quantize(lat: float, long: float, grid: float):
+    """
+        Returns the index of the grid cell the coordinates fall into.
+    """
+    return round(float(lat) / grid), round(float(long) / grid)
+
+
+def cell_center(cell: tuple, grid: float):
+    """
+        Returns the coordinates of the center of a grid cell.
+    """
+    lat = min(max(cell[0] * grid, -90.0), 90.0)
+    long = min(max(cell[1] * grid, -180.0), 180.0)
+    return round(lat, 6), round(long, 6)
+
+
+EARTH_RADIUS = 6371  # km
+
+
+def bounding_box(lat: float, long: float, distance: float):
+    """
+        Returns the latitude range and the list of longitude ranges of a box containing
+        every point within distance km. The longitude list is empty when all longitudes are inside,
+        e.g. near the poles, and has two ranges when the box crosses the antimeridian.
+    """
+    angle = distance / EARTH_RADIUS
+    d_lat = math.degrees(angle)
+    min_lat, max_lat = lat - d_lat, lat + d_lat
+    if min_lat <= -90 or max_lat >= 90 or angle >= math.pi / 2:
+        return (max(min_lat, -90.0), min(max_lat, 90.0)), []
+
+    d_long = math.degrees(math.asin(math.sin(angle) / math.cos(math.radians(lat))))
+    min_long, max_long = long - d_long, long + d_long
+    if min_long < -180:
+        return (min_lat, max_lat), [(min_long + 360, 180.0), (-180.0, max_long)]
+    if max_long > 180:
+        return (min_lat, max_lat), [(min_long, 180.0), (-180.0, max_long - 360)]
+    return (min_lat, max_lat), [(min_long, max_long)]
+
+
+def distance(lat1: float, long1: float, lat2: float, long2: float):
+    """
+        Returns the great circle distance of two points in km.
+    """
+    d_lat = math.radians(lat2 - lat1)
+    d_long = math.radians(long2 - long1)
+    a = math.sin(d_lat / 2) ** 2 + \
+        math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(d_long / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+def unit_vector(lat: float, long: float):
+    """
+        Returns the (x, y, z) unit vector of the point on the sphere, the dot product of two such vectors
+        is the cosine of the angle between the points.
+    """
+    lat, long = math.radians(float(lat)), math.radians(float(long))
+    return math.cos(lat) * math.cos(long), math.cos(lat) * math.sin(long), math.sin(lat)
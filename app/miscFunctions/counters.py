@@ -0,0 +1,49 @@
+import random
+
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from app.miscFunctions.profile_cache import profile_cache
+from app.models import Users_attributes, Like_count_shards
+from app.settings import settings
+
+
+def change_post_count(db: Session, user_id: int, delta: int):
+    """
+        Adds delta to the post count of the profile in the database, the caller commits.
+    """
+    db.query(Users_attributes).filter(Users_attributes.user_id == user_id) \
+        .update({Users_attributes.post_count: Users_attributes.post_count + delta}, synchronize_session=False)
+
+
+def change_like_count(db: Session, user_id: int, delta: int):
+    """
+        Adds delta to the like count of the profile in the database, the caller commits.
+        With COUNTER_SHARDS the delta goes to a random shard row of the profile instead, so concurrent likes
+        of a popular profile do not wait for each other, and flush_like_counts adds it to the profile later.
+    """
+    if settings.COUNTER_SHARDS <= 0:
+        db.query(Users_attributes).filter(Users_attributes.user_id == user_id) \
+            .update({Users_attributes.like_count: Users_attributes.like_count + delta}, synchronize_session=False)
+        return
+    db.execute(insert(Like_count_shards)
+               .values(user_id=user_id, shard=random.randrange(settings.COUNTER_SHARDS), delta=delta)
+               .on_conflict_do_update(index_elements=[Like_count_shards.user_id, Like_count_shards.shard],
+                                      set_={'delta': Like_count_shards.delta + delta}))
+
+
+def flush_like_counts(db: Session):
+    """
+        Adds the collected like count changes to the profiles and removes their shard rows,
+        returns the number of changed profiles. Likes waiting for a removed row store their change in a new one.
+    """
+    flushed = db.execute(text(
+        'WITH flushed AS (DELETE FROM like_count_shards RETURNING user_id, delta), '
+        'totals AS (SELECT user_id, sum(delta) AS delta FROM flushed GROUP BY user_id) '
+        'UPDATE users_attributes SET like_count = users_attributes.like_count + totals.delta '
+        'FROM totals WHERE users_attributes.user_id = totals.user_id RETURNING users_attributes.user_id')).all()
+    db.commit()
+    for profile in flushed:
+        profile_cache.invalidate(profile.user_id)
+    return len(flushed)
@@ -0,0 +1,66 @@
+import threading
+
+from app.miscFunctions.cache import TTLCache
+from app.miscFunctions.coordinates import quantize, cell_center, distance
+from app.settings import settings
+
+
+class FeedCache(TTLCache):
+    """
+        TTL cache of the location feed keyed by the grid cell of the requested location, the distance range
+        and the order. A cell stores the candidate posts within the range widened by its half diagonal
+        around its center, so they contain the posts of every location inside the cell, the pages are cut
+        from them for the exact location of each request.
+        Candidates loaded while a post was written are not stored, invalidate_near bumps the version.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, grid: float):
+        super().__init__(maxsize, ttl)
+        self.grid = grid
+        self._version = 0
+        self._version_lock = threading.Lock()
+
+    def key(self, latitude: float, longitude: float, distance_range: int, order=None):
+        return quantize(latitude, longitude, self.grid), distance_range, order
+
+    def center(self, key):
+        return cell_center(key[0], self.grid)
+
+    def candidate_range(self, key):
+        """
+            Returns the range around the center of the cell which contains the ranges of all its locations.
+        """
+        center_lat, center_long = self.center(key)
+        half = self.grid / 2
+        # the corners nearer to the equator are the farthest ones
+        half_diagonal = max(distance(center_lat, center_long, center_lat + lat_step * half, center_long + half)
+                            for lat_step in (-1, 1))
+        return key[1] + half_diagonal
+
+    def version(self):
+        return self._version
+
+    def put_if_unchanged(self, key, value, version: int):
+        """
+            Stores the candidates unless a post was invalidated since version was read.
+        """
+        with self._version_lock:
+            if version == self._version:
+                self.put(key, value)
+
+    def invalidate_near(self, latitude: float, longitude: float):
+        """
+            Removes every entry whose candidate disk contains the location, returns the number of removed entries.
+        """
+        latitude, longitude = float(latitude), float(longitude)
+
+        def affected(key):
+            center_lat, center_long = self.center(key)
+            return distance(center_lat, center_long, latitude, longitude) <= self.candidate_range(key)
+
+        with self._version_lock:
+            self._version += 1
+            return self.invalidate_where(affected)
+
+
+feed_cache = FeedCache(settings.FEED_CACHE_SIZE, settings.FEED_CACHE_TTL, settings.FEED_GRID_SIZE)
@@ -0,0 +1,66 @@
+import base64
+import datetime
+import json
+
+from sqlalchemy import tuple_
+
+
+class InvalidCursorError(Exception):
+    pass
+
+
+def _encode(values: list):
+    raw = json.dumps(values, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def _decode(cursor: str):
+    raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+    return json.loads(raw)
+
+
+def encode_cursor(date: datetime.datetime, post_id: int):
+    """
+        Returns the opaque cursor pointing after the post with the date and id.
+    """
+    return _encode([date.isoformat(), post_id])
+
+
+def decode_cursor(cursor: str):
+    """
+        Returns (date, post_id) of a cursor made by encode_cursor, raises InvalidCursorError otherwise.
+    """
+    try:
+        date, post_id = _decode(cursor)
+        return datetime.datetime.fromisoformat(date), int(post_id)
+    except (ValueError, TypeError):
+        raise InvalidCursorError()
+
+
+def encode_rank_cursor(reference: datetime.datetime, score: float, post_id: int):
+    """
+        Returns the opaque cursor pointing after the post with the rank score and id.
+        The reference time the scores were computed for is kept, so every page ranks the posts the same way.
+    """
+    return _encode([reference.isoformat(), score, post_id])
+
+
+def decode_rank_cursor(cursor: str):
+    """
+        Returns (reference, score, post_id) of a cursor made by encode_rank_cursor, raises InvalidCursorError otherwise.
+    """
+    try:
+        reference, score, post_id = _decode(cursor)
+        return datetime.datetime.fromisoformat(reference), float(score), int(post_id)
+    except (ValueError, TypeError):
+        raise InvalidCursorError()
+
+
+def after_cursor(date_column, id_column, cursor: str, descending: bool):
+    """
+        Returns the keyset condition of the rows following the cursor in (date, id) order.
+    """
+    date, post_id = decode_cursor(cursor)
+    if descending:
+        return tuple_(date_column, id_column) < tuple_(date, post_id)
+    return tuple_(date_column, id_column) > tuple_(date, post_id)
@@ -0,0 +1,36 @@
+import httpx
+
+from app.settings import settings
+
+# one pooled client per upstream host, so every host has its own connection limit
+_clients = {}
+
+
+def get_client(base_url: str) -> httpx.AsyncClient:
+    """
+        Returns the shared keep-alive client for the given host, it is created on first use.
+    """
+    client = _clients.get(base_url)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            base_url=base_url,
+            limits=httpx.Limits(max_connections=settings.HTTP_MAX_CONNECTIONS_PER_HOST,
+                                max_keepalive_connections=settings.HTTP_MAX_KEEPALIVE_PER_HOST,
+                                keepalive_expiry=settings.HTTP_KEEPALIVE_EXPIRY),
+            timeout=httpx.Timeout(settings.HTTP_READ_TIMEOUT,
+                                  connect=settings.HTTP_CONNECT_TIMEOUT,
+                                  pool=settings.HTTP_POOL_TIMEOUT),
+            # Nominatim usage policy requires an identifying user agent
+            headers={'User-Agent': settings.HTTP_USER_AGENT},
+        )
+        _clients[base_url] = client
+    return client
+
+
+async def close_clients():
+    """
+        Closes every pooled connection, called on application shutdown.
+    """
+    for client in _clients.values():
+        await client.aclose()
+    _clients.clear()
@@ -0,0 +1,153 @@
+import os
+import re
+import uuid
+from abc import ABC, abstractmethod
+
+from sqlalchemy import func, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from app.miscFunctions.images import IMAGE_EXTENSIONS, remove_image
+from app.models import Image_references
+from app.settings import settings
+
+# keys of the content addressed images, pictures uploaded before have random names in flat directories
+_KEY = re.compile(r'[0-9a-f]{64}\.[a-z]+$')
+
+
+class ImageStorage(ABC):
+    """
+        Stores images under keys made of their content hash.
+        Serving and resizing work with files, a remote backend would keep a local copy under path(key).
+    """
+
+    @abstractmethod
+    def path(self, key: str):
+        pass
+
+    @abstractmethod
+    def temp_path(self):
+        """
+            Returns a new path uploads are written to before they are put into the storage.
+        """
+
+    @abstractmethod
+    def put(self, temp_path: str, key: str):
+        """
+            Moves the uploaded file into the storage, returns False when the image was stored already.
+        """
+
+    @abstractmethod
+    def delete(self, key: str):
+        pass
+
+
+class LocalImageStorage(ImageStorage):
+    """
+        Keeps the images on the local disk in nested shard directories named by the leading characters of the hash,
+        e.g. ab/cd/abcd...png, so no directory grows beyond a few thousand entries.
+    """
+
+    def __init__(self, root: str, levels: int = 2, width: int = 2):
+        self.root = root
+        self.levels = levels
+        self.width = width
+
+    def path(self, key: str):
+        shards = [key[level * self.width:(level + 1) * self.width] for level in range(self.levels)]
+        return os.path.join(self.root, *shards, key)
+
+    def temp_path(self):
+        directory = os.path.join(self.root, 'tmp')
+        os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, uuid.uuid4().hex)
+
+    def put(self, temp_path: str, key: str):
+        path = self.path(key)
+        if os.path.exists(path):
+            os.remove(temp_path)
+            return False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # the temporary file is on the same file system, the rename is atomic
+        os.replace(temp_path, path)
+        return True
+
+    def delete(self, key: str):
+        try:
+            remove_image(self.path(key))
+        except FileNotFoundError:
+            pass
+
+
+image_storage = LocalImageStorage(settings.IMAGE_STORE_DIR)
+
+
+def image_key(hash: str, mime: str):
+    return f'{hash}.{IMAGE_EXTENSIONS[mime]}'
+
+
+def image_path(key: str, legacy_directory: str):
+    """
+        Returns the file of a stored picture, pictures uploaded before the storage are in legacy_directory.
+    """
+    if _KEY.match(key):
+        return image_storage.path(key)
+    return os.path.join(legacy_directory, key)
+
+
+def _lock(db: Session, key: str):
+    # serializes the reference changes of one image until the transaction ends
+    db.execute(select(func.pg_advisory_xact_lock(func.hashtext(key))))
+
+
+def publish_image(db: Session, temp_path: str, mime: str, hash: str):
+    """
+        Puts an uploaded image into the storage and adds a reference to it, returns (key, created).
+        created is False when the same image was stored already. The caller commits.
+    """
+    key = image_key(hash, mime)
+    _lock(db, key)
+    db.execute(insert(Image_references).values(key=key, ref_count=1).on_conflict_do_update(
+        index_elements=[Image_references.key],
+        set_={'ref_count': Image_references.ref_count + 1},
+    ))
+    return key, image_storage.put(temp_path, key)
+
+
+def release_image(db: Session, key: str, legacy_directory: str):
+    """
+        Drops a reference to a stored picture. The caller commits. Returns the key when it was the last
+        reference, its file is removed by delete_released once the commit succeeded, otherwise None.
+    """
+    if not _KEY.match(key):
+        return key
+    _lock(db, key)
+    reference = db.query(Image_references).filter(Image_references.key == key).first()
+    if reference is None:
+        return None
+    if reference.ref_count > 1:
+        reference.ref_count = Image_references.ref_count - 1
+        return None
+    db.delete(reference)
+    return key
+
+
+def delete_released(db: Session, keys: list, legacy_directory: str):
+    """
+        Removes the files of the pictures released by release_image in a committed transaction.
+        A picture which was uploaded again in the meantime is kept.
+    """
+    for key in keys:
+        if key is None:
+            continue
+        if not _KEY.match(key):
+            try:
+                remove_image(os.path.join(legacy_directory, key))
+            except FileNotFoundError:
+                pass
+            continue
+        # an upload of the same picture waits for the lock, so it stores the file again after this
+        _lock(db, key)
+        if db.query(Image_references.key).filter(Image_references.key == key).first() is None:
+            image_storage.delete(key)
+        db.commit()
@@ -0,0 +1,350 @@
+import enum
+import hashlib
+import multiprocessing
+import os
+import re
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from PIL import Image, ImageOps
+from starlette.requests import Request
+from starlette.responses import FileResponse, Response, StreamingResponse
+
+from app.miscFunctions.cache import ByteLRUCache
+from app.settings import settings
+
+# leading bytes of the supported image formats
+IMAGE_SIGNATURES = (
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+)
+IMAGE_EXTENSIONS = {'image/jpeg': 'jpeg', 'image/png': 'png'}
+CHUNK_SIZE = 64 * 1024
+
+# post photos never change, a profile picture is revalidated with its ETag on every use
+IMMUTABLE_CACHE_CONTROL = 'private, max-age=31536000, immutable'
+REVALIDATE_CACHE_CONTROL = 'private, no-cache'
+
+_RANGE = re.compile(r'bytes=(\d*)-(\d*)$')
+
+
+class ImageSize(str, enum.Enum):
+    thumb = 'thumb'
+    medium = 'medium'
+    original = 'original'
+
+
+# longest side of the resized variants in pixels, they are re-encoded as JPEG
+VARIANT_SIZES = {
+    ImageSize.medium: settings.IMAGE_MEDIUM_SIZE,
+    ImageSize.thumb: settings.IMAGE_THUMB_SIZE,
+}
+VARIANT_MIME = 'image/jpeg'
+
+_pool = None
+# images whose variants are being generated
+_pending = set()
+# guards _pool and _pending, requests run in the threadpool and results are reported by the pool thread
+_pool_lock = threading.Lock()
+
+# small hot pictures, keyed by (kind, id, size)
+image_cache = ByteLRUCache(settings.IMAGE_CACHE_BYTES, settings.IMAGE_CACHE_MAX_ITEM_BYTES, settings.IMAGE_CACHE_TTL)
+
+
+def sniff_mime(data: bytes):
+    """
+        Returns the MIME type of the image from its leading bytes, or None for unsupported formats.
+    """
+    for signature, mime in IMAGE_SIGNATURES:
+        if data.startswith(signature):
+            return mime
+    return None
+
+
+class InvalidImageError(Exception):
+    pass
+
+
+class ImageTooLargeError(Exception):
+    pass
+
+
+def store_upload(source, path: str, max_size: int):
+    """
+        Copies an uploaded image in chunks to path and returns (mime, hash), the MIME type and hash
+        are stored with the image so reads never inspect it.
+        Raises InvalidImageError when the leading bytes are not a supported image and ImageTooLargeError
+        as soon as more than max_size bytes were read, nothing is left on disk in both cases.
+    """
+    head = source.read(CHUNK_SIZE)
+    mime = sniff_mime(head)
+    if mime is None:
+        raise InvalidImageError()
+
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with open(path, 'wb') as target:
+            chunk = head
+            while chunk:
+                size += len(chunk)
+                if size > max_size:
+                    raise ImageTooLargeError()
+                digest.update(chunk)
+                target.write(chunk)
+                chunk = source.read(CHUNK_SIZE)
+    except BaseException:
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+    return mime, digest.hexdigest()
+
+
+def file_info(path: str):
+    """
+        Returns (mime, hash) of an image file, used for images stored before they were recorded at upload.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        head = file.read(CHUNK_SIZE)
+        chunk = head
+        while chunk:
+            digest.update(chunk)
+            chunk = file.read(CHUNK_SIZE)
+    return sniff_mime(head), digest.hexdigest()
+
+
+def etag_matches(header: str, etag: str):
+    if not header:
+        return False
+    tags = [tag.strip() for tag in header.split(',')]
+    return '*' in tags or etag in tags or 'W/' + etag in tags
+
+
+def parse_range(header: str, size: int):
+    """
+        Returns the (start, end) byte positions of a single range request, or None when the header is ignored.
+        Raises ValueError when the range can not be satisfied.
+    """
+    match = _RANGE.match(header.strip())
+    if match is None:
+        # malformed and multipart ranges are answered with the whole file
+        return None
+    start, end = match.groups()
+    if not start:
+        if not end:
+            return None
+        # suffix range, the last end bytes
+        length = int(end)
+        if length == 0:
+            raise ValueError()
+        return max(size - length, 0), size - 1
+    start = int(start)
+    end = min(int(end), size - 1) if end else size - 1
+    if start >= size:
+        raise ValueError()
+    if start > end:
+        return None
+    return start, end
+
+
+def _read_range(path: str, start: int, end: int):
+    with open(path, 'rb') as file:
+        file.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = file.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def _conditional(request: Request, hash: str, cache_control: str, size: int):
+    """
+        Returns (response, headers, byte range), response is set when the request is answered without content.
+    """
+    etag = f'"{hash}"'
+    headers = {'etag': etag, 'cache-control': cache_control, 'accept-ranges': 'bytes'}
+
+    if etag_matches(request.headers.get('if-none-match'), etag):
+        return Response(status_code=304, headers=headers), headers, None
+
+    range_header = request.headers.get('range')
+    if_range = request.headers.get('if-range')
+    if range_header and (if_range is None or if_range == etag):
+        try:
+            byte_range = parse_range(range_header, size)
+        except ValueError:
+            return Response(status_code=416, headers={'content-range': f'bytes */{size}'}), headers, None
+        if byte_range is not None:
+            start, end = byte_range
+            headers['content-range'] = f'bytes {start}-{end}/{size}'
+            headers['content-length'] = str(end - start + 1)
+            return None, headers, byte_range
+    return None, headers, None
+
+
+def image_response(request: Request, path: str, mime: str, hash: str, cache_control: str, stat_result=None):
+    """
+        Serves an image file without loading it into memory, with a strong ETag of its content hash,
+        304 responses for a matching If-None-Match and single byte ranges.
+        Raises FileNotFoundError when the file is missing.
+    """
+    if stat_result is None:
+        stat_result = os.stat(path)
+    response, headers, byte_range = _conditional(request, hash, cache_control, stat_result.st_size)
+    if response is not None:
+        return response
+    if byte_range is not None:
+        return StreamingResponse(_read_range(path, *byte_range), status_code=206, media_type=mime, headers=headers)
+    return FileResponse(path, media_type=mime, headers=headers, stat_result=stat_result)
+
+
+def content_response(request: Request, content: bytes, mime: str, hash: str, cache_control: str):
+    """
+        Serves an image held in memory like image_response.
+    """
+    response, headers, byte_range = _conditional(request, hash, cache_control, len(content))
+    if response is not None:
+        return response
+    if byte_range is not None:
+        start, end = byte_range
+        return Response(content[start:end + 1], status_code=206, media_type=mime, headers=headers)
+    return Response(content, media_type=mime, headers=headers)
+
+
+def variant_path(path: str, size: ImageSize):
+    """
+        Returns the path of a resized variant of the image, the original for ImageSize.original.
+    """
+    if size == ImageSize.original:
+        return path
+    return f'{os.path.splitext(path)[0]}.{size.value}.jpg'
+
+
+def variant_etag(hash: str, size: ImageSize):
+    return hash if size == ImageSize.original else f'{hash}-{size.value}'
+
+
+def make_variants(path: str, sizes: dict, quality: int):
+    """
+        Writes the resized variants of the image next to it, runs in the worker processes.
+    """
+    with Image.open(path) as image:
+        # JPEGs are decoded directly at a reduced scale
+        image.draft('RGB', (max(sizes.values()),) * 2)
+        # phone cameras store the rotation in EXIF, the variants are saved without it
+        image = ImageOps.exif_transpose(image)
+        if image.mode in ('RGBA', 'LA', 'P'):
+            rgba = image.convert('RGBA')
+            image = Image.new('RGB', rgba.size, (255, 255, 255))
+            image.paste(rgba, mask=rgba.getchannel('A'))
+        else:
+            image = image.convert('RGB')
+        # the largest variant first, the smaller ones are resized from it
+        for size, length in sorted(sizes.items(), key=lambda item: -item[1]):
+            image.thumbnail((length, length))
+            target = variant_path(path, size)
+            image.save(target + '.tmp', 'JPEG', quality=quality, optimize=True)
+            os.replace(target + '.tmp', target)
+
+
+def _report_variants(path, future):
+    with _pool_lock:
+        _pending.discard(path)
+    if not future.cancelled() and future.exception() is not None:
+        print(f'Resizing {path} failed: {future.exception()!r}')
+
+
+def submit_variants(path: str):
+    """
+        Generates the resized variants of an uploaded image in the process pool,
+        unless they are being generated already.
+    """
+    global _pool
+    with _pool_lock:
+        if path in _pending:
+            return
+        if _pool is None:
+            _pool = _new_pool()
+        try:
+            future = _pool.submit(make_variants, path, VARIANT_SIZES, settings.IMAGE_VARIANT_QUALITY)
+        except BrokenProcessPool:
+            # a worker died, e.g. killed when out of memory, and the pool refuses all further work
+            print('The image process pool is broken, it is replaced')
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pending.clear()
+            _pool = _new_pool()
+            future = _pool.submit(make_variants, path, VARIANT_SIZES, settings.IMAGE_VARIANT_QUALITY)
+        _pending.add(path)
+    # outside of the lock, the callback runs at once when the future is already done
+    future.add_done_callback(lambda done: _report_variants(path, done))
+
+
+def _new_pool():
+    # spawned workers do not inherit the locks and connections of the server process
+    return ProcessPoolExecutor(settings.IMAGE_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+
+
+def shutdown_variants():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+        _pending.clear()
+
+
+def remove_image(path: str):
+    """
+        Removes the image together with its resized variants.
+    """
+    os.remove(path)
+    for size in VARIANT_SIZES:
+        try:
+            os.remove(variant_path(path, size))
+        except FileNotFoundError:
+            pass
+
+
+def serve_image(request: Request, cache_key, path: str, mime: str, hash: str, size: ImageSize,
+                cache_control: str):
+    """
+        Serves the requested variant of the image. The original is served while the variant is not generated yet,
+        images uploaded before the variants existed get them generated on first request.
+        Small files are kept in image_cache under cache_key, which may be None to skip the cache.
+        Raises FileNotFoundError when the original is missing.
+    """
+    if size != ImageSize.original:
+        variant = variant_path(path, size)
+        if os.path.exists(variant):
+            path, mime, hash = variant, VARIANT_MIME, variant_etag(hash, size)
+        else:
+            if os.path.exists(path):
+                submit_variants(path)
+            # the original must not be cached as the variant, neither here nor by the client,
+            # its own ETag makes the client fetch the variant once it exists
+            cache_key = None
+            hash = f'{variant_etag(hash, size)}-original'
+            cache_control = REVALIDATE_CACHE_CONTROL
+
+    stat_result = os.stat(path)
+    if cache_key is None or stat_result.st_size > image_cache.max_item_bytes:
+        return image_response(request, path, mime, hash, cache_control, stat_result)
+    with open(path, 'rb') as file:
+        content = file.read()
+    image_cache.put(cache_key, content, (mime, hash))
+    return content_response(request, content, mime, hash, cache_control)
+
+
+def cached_image_response(request: Request, cache_key, cache_control: str):
+    """
+        Serves the image cached under cache_key, returns None on a miss.
+    """
+    cached = image_cache.get(cache_key)
+    if cached is None:
+        return None
+    content, (mime, hash) = cached
+    return content_response(request, content, mime, hash, cache_control)
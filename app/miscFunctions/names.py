@@ -0,0 +1,11 @@
+import unicodedata
+
+
+def normalize_name(*parts: str):
+    """
+        Returns the searchable form of a name, lower case without diacritics and with single spaces,
+        e.g. ('Ján', 'Nováková') is 'jan novakova'. Search strings are normalized the same way.
+    """
+    decomposed = unicodedata.normalize('NFKD', ' '.join(parts))
+    stripped = ''.join(char for char in decomposed if not unicodedata.combining(char))
+    return ' '.join(stripped.casefold().split())
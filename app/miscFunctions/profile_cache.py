@@ -0,0 +1,7 @@
+from app.miscFunctions.cache import TTLCache
+from app.settings import settings
+
+# public part of the profiles keyed by the user id, everything get_profile returns except the interaction.
+# Entries are invalidated on farm, picture, like and post changes of this process, other workers see them
+# after PROFILE_CACHE_TTL, a size of 0 disables the cache
+profile_cache = TTLCache(settings.PROFILE_CACHE_SIZE, settings.PROFILE_CACHE_TTL)
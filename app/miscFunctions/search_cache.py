@@ -0,0 +1,115 @@
+import asyncio
+import re
+import time
+
+from app.miscFunctions.cache import TTLCache
+
+_WORDS = re.compile(r'\w+')
+
+
+def normalize_query(query: str):
+    """
+        Lower cases the search string and collapses whitespace, so equal searches share one cache entry.
+    """
+    return ' '.join(query.casefold().split())
+
+
+def matches_query(display_name: str, query: str):
+    """
+        True when every word of the query is the beginning of a word of the display name.
+    """
+    words = _WORDS.findall((display_name or '').casefold())
+    return all(any(word.startswith(token) for word in words) for token in _WORDS.findall(query))
+
+
+class SearchCache(TTLCache):
+    """
+        TTL cache of location searches remembering which of them returned all their results.
+        A query can be answered from a cached shorter query it starts with, e.g. "bratislava" from "brati",
+        when that query returned fewer results than the upstream limit, so none of the matches are missing.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, prefix_min_length: int):
+        super().__init__(maxsize, ttl)
+        self.prefix_min_length = prefix_min_length
+        self.prefix_hits = 0
+        self._complete = set()
+
+    def put(self, key, value, ttl: float = None, complete: bool = False):
+        super().put(key, value, ttl)
+        with self._lock:
+            if complete:
+                self._complete.add(key)
+            else:
+                self._complete.discard(key)
+            # evicted queries are dropped from the set once it grows too much
+            if len(self._complete) > 2 * max(self.maxsize, 1):
+                self._complete.intersection_update(self._data)
+
+    def get_prefix(self, query: str):
+        """
+            Returns the cached results of the longest complete shorter query matching the query, or None.
+        """
+        for length in range(len(query) - 1, self.prefix_min_length - 1, -1):
+            prefix = query[:length]
+            with self._lock:
+                if prefix not in self._complete:
+                    continue
+            results = self.peek(prefix)
+            if not results:
+                continue
+            matching = [item for item in results if matches_query(item['display_name'], query)]
+            if matching:
+                with self._lock:
+                    self.prefix_hits += 1
+                return matching
+        return None
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._complete.clear()
+
+    def stats(self):
+        stats = super().stats()
+        stats['prefix_hits'] = self.prefix_hits
+        return stats
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class Pacer:
+    """
+        FIFO queue letting callers through at most once per interval seconds.
+        Raises QueueFullError when more than max_waiting callers are already waiting.
+    """
+
+    def __init__(self, interval: float, max_waiting: int):
+        self.interval = interval
+        self.max_waiting = max_waiting
+        self.waiting = 0
+        self.rejected = 0
+        self._next = 0.0
+        # created on first use, so it belongs to the running event loop
+        self._lock = None
+
+    async def wait(self):
+        if self.waiting >= self.max_waiting:
+            self.rejected += 1
+            raise QueueFullError()
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        self.waiting += 1
+        try:
+            async with self._lock:
+                delay = self._next - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                self._next = time.monotonic() + self.interval
+        finally:
+            self.waiting -= 1
+
+    def stats(self):
+        return {'waiting': self.waiting, 'rejected': self.rejected}
@@ -0,0 +1,48 @@
+import asyncio
+
+
+class SingleFlight:
+    """
+        Coalesces concurrent calls with the same key into a single execution.
+        The first caller starts the coroutine, everyone else awaits the same task and shares its result.
+    """
+
+    def __init__(self):
+        self._tasks = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    def start(self, key, func):
+        """
+            Starts func() in the background unless a call of the key is already in flight, returns its task.
+        """
+        task = self._tasks.get(key)
+        if task is None:
+            self.calls += 1
+            task = asyncio.ensure_future(func())
+            self._tasks[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done))
+        else:
+            self.coalesced += 1
+        return task
+
+    async def do(self, key, func):
+        """
+            Awaits func() for the key, or joins the call already in flight.
+            The task is shielded, so a cancelled caller does not cancel the others.
+        """
+        return await asyncio.shield(self.start(key, func))
+
+    def _finish(self, key, task):
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+        # mark the exception as retrieved, when every caller was cancelled nobody else reads it
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self):
+        return {
+            'calls': self.calls,
+            'coalesced': self.coalesced,
+            'in_flight': len(self._tasks),
+        }
@@ -0,0 +1,56 @@
+from fastapi import HTTPException
+from starlette.responses import JSONResponse
+from starlette.status import HTTP_413_REQUEST_ENTITY_TOO_LARGE
+
+DETAIL = "Request body is too large."
+
+
+class UploadLimitMiddleware:
+    """
+        Limits the size of multipart request bodies. The form is parsed and spooled to disk before
+        the endpoint runs, so the limits of the endpoints apply only after the whole body was received.
+        Requests declaring a larger Content-Length are refused before their body is read, the others are
+        counted while they are received and refused as soon as they exceed max_body_size.
+    """
+
+    def __init__(self, app, max_body_size: int):
+        self.app = app
+        self.max_body_size = max_body_size
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not _is_multipart(scope):
+            await self.app(scope, receive, send)
+            return
+
+        content_length = _header(scope, b'content-length')
+        if content_length is not None and content_length.isdigit() and int(content_length) > self.max_body_size:
+            response = JSONResponse({'detail': DETAIL}, status_code=HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                                    headers={'connection': 'close'})
+            await response(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message['type'] == 'http.request':
+                received += len(message.get('body', b''))
+                if received > self.max_body_size:
+                    # raised inside the form parsing, the endpoint answers it like its own HTTPExceptions
+                    raise HTTPException(status_code=HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=DETAIL)
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+def _header(scope, name: bytes):
+    for key, value in scope['headers']:
+        if key == name:
+            return value.decode('latin-1')
+    return None
+
+
+def _is_multipart(scope):
+    content_type = _header(scope, b'content-type')
+    return content_type is not None and content_type.lower().startswith('multipart/form-data')
@@ -0,0 +1,60 @@
+from app.schemas.weather_schema import WeatherPydantic, WeatherVariables, WeatherVariablesDaily
+
+# nested objects of the OpenWeatherMap responses, a field called <object>_<key> is read from data[object][key]
+NESTED_OBJECTS = ('feels_like', 'weather', 'coord', 'clouds', 'main', 'wind', 'rain', 'snow', 'temp', 'sys')
+
+_MISSING = object()
+
+
+def field_path(field: str):
+    """
+        Returns the path of a schema field in the response, e.g. main_feels_like -> ('main', 'feels_like').
+    """
+    for obj in NESTED_OBJECTS:
+        if field.startswith(obj + '_'):
+            return obj, field[len(obj) + 1:]
+    return field,
+
+
+def city_path(field: str):
+    """
+        Forecast responses keep the location in 'city', the sys_ prefix is not used there.
+    """
+    path = field_path(field)
+    if path[0] == 'sys':
+        path = path[1:]
+    return ('city',) + path
+
+
+def build_extractor(model, path=field_path):
+    """
+        Precompiles the path of every field of the pydantic model and returns a function,
+        which reads them straight from a response into a flat dict.
+        Missing values are 0 and lists take their last element, the same way flattening the response did.
+    """
+    paths = tuple((name, path(name)) for name in model.__fields__)
+
+    def extract(data: dict):
+        row = {}
+        for name, keys in paths:
+            value = data
+            for key in keys:
+                if value.__class__ is list:
+                    value = value[-1] if value else _MISSING
+                if value.__class__ is not dict:
+                    value = _MISSING
+                    break
+                value = value.get(key, _MISSING)
+            # flattening never produced keys for nested objects, so they count as missing
+            if value is _MISSING or value.__class__ is dict or value.__class__ is list:
+                value = 0
+            row[name] = value
+        return row
+
+    return extract
+
+
+extract_weather = build_extractor(WeatherPydantic)
+extract_city = build_extractor(WeatherPydantic, path=city_path)
+extract_variables = build_extractor(WeatherVariables)
+extract_variables_daily = build_extractor(WeatherVariablesDaily)
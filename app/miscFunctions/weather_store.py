@@ -0,0 +1,114 @@
+import datetime
+from decimal import Decimal
+
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from app.models import Weather, WeatherType, Weather_variables, Weather_variables_daily, Weather_current, \
+    Weather_hourly, Weather_daily
+from app.schemas.weather_schema import WeatherPydantic, WeatherVariables, WeatherVariablesDaily
+
+# snapshot table, variables table, variables schema and the column which orders the rows of every weather type
+SNAPSHOT_TABLES = {
+    WeatherType.Current: (Weather_current, Weather_variables, WeatherVariables, None),
+    WeatherType.Hourly: (Weather_hourly, Weather_variables, WeatherVariables, 'hour'),
+    WeatherType.Daily: (Weather_daily, Weather_variables_daily, WeatherVariablesDaily, 'day'),
+}
+
+
+def _row_dict(row, fields):
+    values = {}
+    for key in fields:
+        value = getattr(row, key)
+        if isinstance(value, Decimal):
+            # whole numbers stay ints like in the upstream response, so 13 is not turned into 13.0
+            value = int(value) if value == value.to_integral_value() else float(value)
+        values[key] = value
+    return values
+
+
+def load_snapshot(db: Session, type: WeatherType, cell_lat: float, cell_lon: float, max_age: float):
+    """
+        Returns (weather, refresh_time) of the stored snapshot of a grid cell,
+        or None when there is no snapshot or it is older than max_age seconds.
+    """
+    snapshot_table, variables_table, variables_schema, order = SNAPSHOT_TABLES[type]
+    weather = db.query(Weather).filter(Weather.cell_lat == cell_lat,
+                                       Weather.cell_lon == cell_lon,
+                                       Weather.type == type).first()
+    if weather is None:
+        return None
+
+    query = db.query(snapshot_table.refresh_time, variables_table) \
+        .join(variables_table, variables_table.id == snapshot_table.variables_id) \
+        .filter(snapshot_table.weather_id == weather.id)
+    if order:
+        query = query.order_by(getattr(snapshot_table, order))
+    rows = query.all()
+    if not rows:
+        return None
+
+    refresh_time = min(row.refresh_time for row in rows)
+    if (datetime.datetime.utcnow() - refresh_time).total_seconds() > max_age:
+        return None
+
+    variables = [_row_dict(row[1], variables_schema.__fields__) for row in rows]
+    result = {'weather': _row_dict(weather, WeatherPydantic.__fields__),
+              'variables': variables[0] if type == WeatherType.Current else variables}
+    return result, refresh_time
+
+
+def save_snapshot(db: Session, type: WeatherType, cell_lat: float, cell_lon: float, result: dict):
+    """
+        Replaces the stored snapshot of a grid cell with a freshly parsed weather response.
+    """
+    try:
+        return _save_snapshot(db, type, cell_lat, cell_lon, result)
+    except IntegrityError:
+        # another worker created the snapshot of the cell at the same time, its data is as fresh as ours
+        db.rollback()
+        return None
+
+
+def _save_snapshot(db: Session, type: WeatherType, cell_lat: float, cell_lon: float, result: dict):
+    snapshot_table, variables_table, variables_schema, order = SNAPSHOT_TABLES[type]
+    weather = db.query(Weather).filter(Weather.cell_lat == cell_lat,
+                                       Weather.cell_lon == cell_lon,
+                                       Weather.type == type).with_for_update().first()
+    if weather is None:
+        weather = Weather(cell_lat=cell_lat, cell_lon=cell_lon, type=type)
+        db.add(weather)
+    for key, value in result['weather'].items():
+        setattr(weather, key, value)
+    db.flush()
+
+    # link rows are removed together with their variables by the cascade
+    old_variables = db.query(snapshot_table.variables_id).filter(snapshot_table.weather_id == weather.id)
+    db.query(variables_table).filter(variables_table.id.in_(old_variables.scalar_subquery())) \
+        .delete(synchronize_session=False)
+
+    rows = result['variables'] if type != WeatherType.Current else [result['variables']]
+    variables = [variables_table(**{key: row.get(key) for key in variables_schema.__fields__}) for row in rows]
+    db.add_all(variables)
+    db.flush()
+
+    refresh_time = datetime.datetime.utcnow()
+    for index, row in enumerate(variables):
+        link = snapshot_table(weather_id=weather.id, variables_id=row.id, refresh_time=refresh_time)
+        if order:
+            setattr(link, order, index)
+        db.add(link)
+    db.commit()
+    return refresh_time
+
+
+def load_refresh_times(db: Session, type: WeatherType):
+    """
+        Returns {(cell_lat, cell_lon): refresh_time} of every stored snapshot of the weather type.
+    """
+    snapshot_table = SNAPSHOT_TABLES[type][0]
+    query = db.query(Weather.cell_lat, Weather.cell_lon, snapshot_table.refresh_time) \
+        .join(snapshot_table, snapshot_table.weather_id == Weather.id) \
+        .filter(Weather.type == type) \
+        .distinct()
+    return {(float(row.cell_lat), float(row.cell_lon)): row.refresh_time for row in query}
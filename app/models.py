@@ -1,7 +1,8 @@
 import enum
 
-from sqlalchemy import Column, Integer, Boolean, ForeignKey, text, CheckConstraint, NUMERIC, Enum
-from sqlalchemy.dialects.postgresql import BYTEA
+from sqlalchemy import Column, Integer, Boolean, ForeignKey, text, CheckConstraint, NUMERIC, Enum, UniqueConstraint, \
+    Index
+from sqlalchemy.dialects.postgresql import BYTEA, DOUBLE_PRECISION
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql.sqltypes import TIMESTAMP, VARCHAR, TEXT
 
@@ -17,7 +18,21 @@ class Users(Base):
     password = Column(VARCHAR(60), nullable=False)
     email = Column(VARCHAR(50), nullable=False)
     photo = Column(VARCHAR(100), nullable=True)
+    # recorded at upload, so the picture is served without inspecting the file
+    photo_mime = Column(VARCHAR(50), nullable=True)
+    photo_hash = Column(VARCHAR(64), nullable=True)
     registration_date = Column(TIMESTAMP(timezone=False), nullable=False, server_default=text('now()'))
+    # normalized "first last" and "last first" names matched by the profile search, see normalize_name
+    search_name = Column(VARCHAR(101))
+    search_name_reverse = Column(VARCHAR(101))
+    __table_args__ = (
+        # every login and registration looks the user up by the email
+        UniqueConstraint('email', name='users_email_key'),
+        # prefix search, the trigram index of search_name is created by the migrations when pg_trgm is available
+        Index('users_search_name_idx', 'search_name', postgresql_ops={'search_name': 'varchar_pattern_ops'}),
+        Index('users_search_name_reverse_idx', 'search_name_reverse',
+              postgresql_ops={'search_name_reverse': 'varchar_pattern_ops'}),
+    )
 
 
 class Users_attributes(Base):
@@ -28,22 +43,34 @@ class Users_attributes(Base):
     like_count = Column(Integer, CheckConstraint("like_count >= 0"), nullable=False, default=0)
     user_id = Column(Integer, ForeignKey(Users.id, ondelete='CASCADE'))
     #user = relationship('users', )
+    __table_args__ = (UniqueConstraint('user_id', name='users_attributes_user_id_key'),)
 
 
-"""class Weather(Base):
+class WeatherType(enum.Enum):
+    Current = 1
+    Hourly = 2
+    Daily = 3
+
+
+class Weather(Base):
     __tablename__ = "weather"
 
     id = Column(Integer, primary_key=True)
-    coord_lat = Column(NUMERIC(5, 3), unique=True)
-    coord_lon = Column(NUMERIC(6, 3), unique=True)
+    # center of the grid cell the snapshot belongs to
+    cell_lat = Column(NUMERIC(8, 5), nullable=False)
+    cell_lon = Column(NUMERIC(9, 5), nullable=False)
+    type = Column(Enum(WeatherType), nullable=False)
+    coord_lat = Column(NUMERIC(8, 5))
+    coord_lon = Column(NUMERIC(9, 5))
     timezone = Column(Integer)
-    name = Column(VARCHAR(50))
+    name = Column(VARCHAR(255))
     sys_country = Column(VARCHAR(50))
     sys_sunset = Column(Integer)
     sys_sunrise = Column(Integer)
     current = relationship('Weather_current', backref='weather')
-    hourly = relationship('Weather_hourly', backref='weather')
-    farms = relationship('Farms', backref='weather')"""
+    hourly = relationship('Weather_hourly', backref='weather', order_by='Weather_hourly.hour')
+    daily = relationship('Weather_daily', backref='weather', order_by='Weather_daily.day')
+    __table_args__ = (UniqueConstraint('cell_lat', 'cell_lon', 'type', name='weather_cell_type_key'),)
 
 
 class Farms(Base):
@@ -58,6 +85,7 @@ class Farms(Base):
     #user = relationship("Users")
     CheckConstraint('latitude <= 90 and latitude >= -90', name='latitude_check'),
     CheckConstraint('longitude <= 180 and longitude >= -180', name='longitude_check'),
+    __table_args__ = (Index('farms_user_id_idx', 'user_id'),)
 
 
 """class Likes_dislikes(Base):
@@ -75,6 +103,8 @@ class Interactions(Base):
 
     follower = Column(Integer, ForeignKey(Users.id, ondelete='cascade'), primary_key=True)
     followed_profile = Column(Integer, ForeignKey(Users.id, ondelete='cascade'), primary_key=True)
+    # the primary key starts with the follower, the followers of a profile are looked up by this one
+    __table_args__ = (Index('interactions_followed_profile_follower_idx', 'followed_profile', 'follower'),)
 
 
 class Posts(Base):
@@ -87,10 +117,21 @@ class Posts(Base):
     category = Column(VARCHAR(50), nullable=False)
     text = Column(TEXT, default='')
     date = Column(TIMESTAMP, default='now()')
+    # unit vector of the location, the feed compares its dot product with the cosine of the range
+    unit_x = Column(DOUBLE_PRECISION)
+    unit_y = Column(DOUBLE_PRECISION)
+    unit_z = Column(DOUBLE_PRECISION)
     CheckConstraint('latitude <= 90 and latitude >= -90', name='latitude_check')
     CheckConstraint('longitude <= 180 and longitude >= -180', name='longitude_check')
     #post_photos = relationship('Post_photos', backref='posts')
     post_photos = relationship('Post_photos', back_populates='post')
+    __table_args__ = (
+        # bounding box prefilter of the location feed
+        Index('posts_latitude_longitude_idx', 'latitude', 'longitude'),
+        # (date, id) keyset pages of the location and profile feeds
+        Index('posts_date_id_idx', 'date', 'id'),
+        Index('posts_user_id_date_id_idx', 'user_id', 'date', 'id'),
+    )
 
 
 """class Comments(Base):
@@ -109,7 +150,44 @@ class Post_photos(Base):
     id = Column(Integer, primary_key=True)
     post_id = Column(Integer, ForeignKey(Posts.id, ondelete='cascade'))
     photo = Column(VARCHAR(100))
+    # recorded at upload, so the photo is served without inspecting the file
+    mime = Column(VARCHAR(50))
+    hash = Column(VARCHAR(64))
     post = relationship('Posts', back_populates='post_photos')
+    __table_args__ = (Index('post_photos_post_id_idx', 'post_id'),)
+
+
+class Notification_outbox(Base):
+    __tablename__ = 'notification_outbox'
+
+    id = Column(Integer, primary_key=True)
+    post_id = Column(Integer, ForeignKey(Posts.id, ondelete='cascade'), nullable=False)
+    user_id = Column(Integer, ForeignKey(Users.id, ondelete='cascade'), nullable=False)
+    title = Column(VARCHAR(255), nullable=False)
+    body = Column(TEXT, nullable=False)
+    # followers are notified in the order of their ids, the ones up to last_follower already were
+    last_follower = Column(Integer, nullable=False, default=0)
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt = Column(TIMESTAMP, nullable=False, server_default=text('now()'))
+    created = Column(TIMESTAMP, nullable=False, server_default=text('now()'))
+    __table_args__ = (Index('notification_outbox_next_attempt_idx', 'next_attempt'),)
+
+
+class Like_count_shards(Base):
+    __tablename__ = 'like_count_shards'
+
+    # like count changes of a profile not flushed into users_attributes yet, spread over several rows
+    user_id = Column(Integer, ForeignKey(Users.id, ondelete='cascade'), primary_key=True)
+    shard = Column(Integer, primary_key=True)
+    delta = Column(Integer, nullable=False, default=0)
+
+
+class Image_references(Base):
+    __tablename__ = 'image_references'
+
+    # content hash and extension of a stored image, shared by every upload of the same picture
+    key = Column(VARCHAR(100), primary_key=True)
+    ref_count = Column(Integer, CheckConstraint("ref_count >= 0"), nullable=False, default=0)
 
 
 class Settings(Base):
@@ -123,18 +201,22 @@ class Settings(Base):
     news_notifications = Column(Boolean, default=True)
     fcm_token = Column(VARCHAR(255))
     #user = relationship("Users")
+    __table_args__ = (UniqueConstraint('user_id', name='settings_user_id_key'),)
 
 #weather
 
 
-"""class Weather_variables(Base):
+class Weather_variables(Base):
     __tablename__ = "weather_variables"
 
     id = Column(Integer, primary_key=True)
     weather_main = Column(VARCHAR(50))
     weather_description = Column(TEXT)
     weather_icon = Column(VARCHAR(5))
+    weather_id = Column(Integer)
     main_temp = Column(NUMERIC(4, 2))
+    main_temp_min = Column(NUMERIC(4, 2))
+    main_temp_max = Column(NUMERIC(4, 2))
     main_feels_like = Column(NUMERIC(4, 2))
     main_pressure = Column(Integer)
     main_humidity = Column(Integer)
@@ -152,6 +234,36 @@ class Settings(Base):
     hourly = relationship('Weather_hourly', backref='weather_variables')
 
 
+class Weather_variables_daily(Base):
+    __tablename__ = "weather_variables_daily"
+
+    id = Column(Integer, primary_key=True)
+    temp_day = Column(NUMERIC(4, 2))
+    temp_min = Column(NUMERIC(4, 2))
+    temp_max = Column(NUMERIC(4, 2))
+    temp_night = Column(NUMERIC(4, 2))
+    temp_eve = Column(NUMERIC(4, 2))
+    temp_morn = Column(NUMERIC(4, 2))
+    feels_like_day = Column(NUMERIC(4, 2))
+    feels_like_night = Column(NUMERIC(4, 2))
+    feels_like_eve = Column(NUMERIC(4, 2))
+    feels_like_morn = Column(NUMERIC(4, 2))
+    pressure = Column(Integer)
+    humidity = Column(Integer)
+    weather_main = Column(VARCHAR(50))
+    weather_icon = Column(VARCHAR(5))
+    weather_description = Column(TEXT)
+    weather_id = Column(Integer)
+    wind_speed = Column(NUMERIC(5, 2))
+    wind_deg = Column(Integer)
+    wind_gust = Column(NUMERIC(5, 2))
+    clouds = Column(NUMERIC(5, 2))
+    rain = Column(NUMERIC(5, 2))
+    snow = Column(NUMERIC(5, 2))
+    pop = Column(NUMERIC(5, 2))
+    daily = relationship('Weather_daily', backref='weather_variables')
+
+
 class Weather_current(Base):
     __tablename__ = 'weather_current'
 
@@ -166,4 +278,13 @@ class Weather_hourly(Base):
     weather_id = Column(Integer, ForeignKey(Weather.id, ondelete='cascade'), primary_key=True)
     variables_id = Column(Integer, ForeignKey(Weather_variables.id, ondelete='cascade'), primary_key=True)
     hour = Column(Integer)
-    refresh_time = Column(TIMESTAMP(timezone=False))"""
+    refresh_time = Column(TIMESTAMP(timezone=False))
+
+
+class Weather_daily(Base):
+    __tablename__ = 'weather_daily'
+
+    weather_id = Column(Integer, ForeignKey(Weather.id, ondelete='cascade'), primary_key=True)
+    variables_id = Column(Integer, ForeignKey(Weather_variables_daily.id, ondelete='cascade'), primary_key=True)
+    day = Column(Integer)
+    refresh_time = Column(TIMESTAMP(timezone=False))
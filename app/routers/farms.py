@@ -9,6 +9,7 @@ from app.security import auth
 
 from app.schemas.farms_schema import PostFarm, DeleteFarm, GetFarms
 from app.miscFunctions.coordinates import check_coors
+from app.miscFunctions.profile_cache import profile_cache
 from app.models import Farms, Users
 
 router = APIRouter(
@@ -35,6 +36,7 @@ def add_farm(post_farm: PostFarm,
     db.add(farm)
     db.commit()
     db.refresh(farm)
+    profile_cache.invalidate(user.id)
     return
 
 
@@ -49,6 +51,7 @@ def delete_farm(
     if farm:
         db.delete(farm)
         db.commit()
+        profile_cache.invalidate(user.id)
     else:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -1,7 +1,7 @@
-import random
-import string
+import math
+import os
 
-from fastapi import APIRouter, HTTPException, status, Depends, UploadFile, File
+from fastapi import APIRouter, HTTPException, status, Depends, UploadFile, File, Query, BackgroundTasks
 from sqlalchemy.orm import Session, aliased
 from starlette.responses import StreamingResponse, Response
 
@@ -9,18 +9,27 @@ from app.models import Users, Posts, Settings
 from starlette.status import HTTP_200_OK, HTTP_404_NOT_FOUND, HTTP_422_UNPROCESSABLE_ENTITY, HTTP_405_METHOD_NOT_ALLOWED
 from typing import List, Optional
 
-import io
-
-from app.db.database import create_connection
+from app.db.database import create_connection, run_with_session
 from app.security import auth
 
-from app.schemas.feed_schema import NewPost, GetFeed, GetFeedResponse
-from app.miscFunctions.coordinates import check_coors
-from app.models import Farms, Users, Users_attributes, Post_photos, Interactions
-from sqlalchemy import func, text, select, desc
-from app.routers.profile import check_if_picture
+from app.schemas.feed_schema import NewPost, GetFeed, GetFeedResponse, FeedOrder
+from app.miscFunctions.coordinates import check_coors, bounding_box, unit_vector, EARTH_RADIUS
+from app.miscFunctions.feed_cursor import encode_cursor, decode_cursor, after_cursor, encode_rank_cursor, \
+    decode_rank_cursor, InvalidCursorError
+from app.miscFunctions.feed_cache import feed_cache
+from app.miscFunctions.profile_cache import profile_cache
+from app.miscFunctions.counters import change_post_count
+from app.miscFunctions.images import file_info, serve_image, cached_image_response, submit_variants, image_cache, \
+    ImageSize, IMMUTABLE_CACHE_CONTROL
+from starlette.requests import Request
+from app.settings import settings
+from app.models import Farms, Users, Post_photos, Interactions, Notification_outbox
+from sqlalchemy import func, text, select, desc, or_, extract, literal, tuple_
+from sqlalchemy.sql.sqltypes import TIMESTAMP
+from app.routers.profile import receive_picture
+from app.miscFunctions.image_storage import image_storage, image_path, publish_image, release_image, \
+    delete_released
 import datetime
-from PIL import Image
 from firebase_admin import messaging
 
 router = APIRouter(
@@ -30,6 +39,114 @@ router = APIRouter(
 )
 
 
+NEXT_CURSOR_HEADER = 'Next-Cursor'
+
+
+def distance_filter(latitude: float, longitude: float, distance_range: float):
+    """
+        Returns the conditions of posts within distance_range km. The bounding box uses the index
+        on the coordinates, the posts inside the box are compared by the dot product of their unit vectors.
+    """
+    (min_lat, max_lat), long_ranges = bounding_box(latitude, longitude, distance_range)
+    conditions = [Posts.latitude.between(min_lat, max_lat)]
+    if long_ranges:
+        conditions.append(or_(*[Posts.longitude.between(min_long, max_long) for min_long, max_long in long_ranges]))
+    # the cosine grows again past half the circumference, such a range covers the whole globe
+    if distance_range < math.pi * EARTH_RADIUS:
+        conditions.append(unit_dot(latitude, longitude) > math.cos(distance_range / EARTH_RADIUS))
+    return conditions
+
+
+def unit_dot(latitude: float, longitude: float):
+    """
+        Returns the cosine of the angle between the posts and the location. The vector of a post without
+        a stored one, e.g. inserted by an older worker or not backfilled yet, is computed from its coordinates.
+    """
+    x, y, z = unit_vector(latitude, longitude)
+    post_lat, post_long = func.radians(Posts.latitude), func.radians(Posts.longitude)
+    unit_x = func.coalesce(Posts.unit_x, func.cos(post_lat) * func.cos(post_long))
+    unit_y = func.coalesce(Posts.unit_y, func.cos(post_lat) * func.sin(post_long))
+    unit_z = func.coalesce(Posts.unit_z, func.sin(post_lat))
+    return unit_x * x + unit_y * y + unit_z * z
+
+
+def rank_score(latitude: float, longitude: float, distance_range: float, reference: datetime.datetime):
+    """
+        Returns the nearest_newest score of the posts, lower is better. The distance is relative to the range
+        and the age at the reference time is relative to FEED_RANK_AGE_SCALE.
+    """
+    distance = EARTH_RADIUS * func.acos(func.least(1.0, unit_dot(latitude, longitude)))
+    age = extract('epoch', literal(reference, TIMESTAMP) - Posts.date)
+    return distance / distance_range + age / settings.FEED_RANK_AGE_SCALE
+
+
+def feed_response(db: Session, posts):
+    """
+        Builds the feed response of the posts, the photo ids of all posts are loaded with a single query.
+    """
+    photos = {post.id: [] for post in posts}
+    if photos:
+        photo_result = db.query(Post_photos.post_id, Post_photos.id) \
+            .filter(Post_photos.post_id.in_(list(photos))) \
+            .order_by(Post_photos.id).all()
+        for photo in photo_result:
+            photos[photo.post_id].append(photo.id)
+    return [GetFeedResponse(**post, photos_id=photos[post.id]) for post in posts]
+
+
+def feed_page(query, date_column, id_column, limit: int, cursor: Optional[str], descending: bool):
+    """
+        Returns (rows, next cursor) of one page of the feed query in (date, id) order starting after the cursor.
+        The next cursor is None when there are no more posts.
+    """
+    if cursor:
+        try:
+            query = query.filter(after_cursor(date_column, id_column, cursor, descending))
+        except InvalidCursorError:
+            raise HTTPException(
+                status_code=HTTP_422_UNPROCESSABLE_ENTITY,
+                detail="Invalid cursor.",
+            )
+    if descending:
+        query = query.order_by(desc(date_column), desc(id_column))
+    else:
+        query = query.order_by(date_column, id_column)
+    # one extra row tells whether there is a next page
+    result = query.limit(limit + 1).all()
+    if len(result) <= limit:
+        return result, None
+    result = result[:limit]
+    return result, encode_cursor(result[-1].date, result[-1].id)
+
+
+def ranked_feed_page(query, latitude: float, longitude: float, distance_range: float, limit: int,
+                     cursor: Optional[str]):
+    """
+        Returns (rows, next cursor) of one page of the location feed query in nearest_newest order.
+    """
+    reference = datetime.datetime.now()
+    after = None
+    if cursor:
+        try:
+            reference, score, post_id = decode_rank_cursor(cursor)
+        except InvalidCursorError:
+            raise HTTPException(
+                status_code=HTTP_422_UNPROCESSABLE_ENTITY,
+                detail="Invalid cursor.",
+            )
+        after = (score, post_id)
+
+    score = rank_score(latitude, longitude, distance_range, reference)
+    query = query.add_columns(score.label('score'))
+    if after:
+        query = query.filter(tuple_(score, Posts.id) > tuple_(*after))
+    result = query.order_by(score, Posts.id).limit(limit + 1).all()
+    if len(result) <= limit:
+        return result, None
+    result = result[:limit]
+    return result, encode_rank_cursor(reference, result[-1].score, result[-1].id)
+
+
 @router.get("/", status_code=HTTP_200_OK,
             response_model=list[GetFeedResponse],
             summary="Retrieves the available posts based on distance",
@@ -37,32 +154,129 @@ router = APIRouter(
 def news_feed(distance_range: int,
               latitude: float,
               longitude: float,
+              response: Response,
+              limit: int = Query(settings.FEED_PAGE_SIZE, ge=1, le=settings.FEED_MAX_PAGE_SIZE),
+              cursor: Optional[str] = None,
+              order: FeedOrder = FeedOrder.newest,
               user: Users = Depends(auth.get_current_user),
               db: Session = Depends(create_connection)):
+    """
+        Input parameters:
+        - **limit**: number of posts in the page
+        - **cursor**: Next-Cursor header of the previous page, the first page is returned without it
+        - **order**: newest first, or nearest_newest mixing the distance and the age of the posts
+
+        Response values:
+        - the posts within distance_range km, the Next-Cursor header is set when there are more posts
+
+        The candidate posts are cached for the grid cell of the location, a cell with more than
+        FEED_CACHE_MAX_POSTS candidates is queried for every page.
+    """
+    key = feed_cache.key(latitude, longitude, distance_range, order)
+    candidates = feed_cache.get(key)
+    if candidates is None:
+        version = feed_cache.version()
+        candidates = load_feed_candidates(db, *feed_cache.center(key), feed_cache.candidate_range(key),
+                                          settings.FEED_CACHE_MAX_POSTS)
+        feed_cache.put_if_unchanged(key, candidates, version)
+
+    if candidates is False:
+        post_list, next_cursor = load_news_feed(db, latitude, longitude, distance_range, limit, cursor, order)
+    else:
+        post_list, next_cursor = candidates_page(candidates, latitude, longitude, distance_range, limit,
+                                                 cursor, order)
+    if next_cursor:
+        response.headers[NEXT_CURSOR_HEADER] = next_cursor
+    if not post_list and not cursor:
+        raise HTTPException(
+            status_code=HTTP_404_NOT_FOUND,
+            detail="Feed is empty.",
+        )
+    return post_list
+
+
+def load_feed_candidates(db: Session, latitude: float, longitude: float, distance_range: float, max_posts: int):
+    """
+        Returns the feed responses of all posts within distance_range km, newest first,
+        or False when there are more than max_posts of them.
+    """
+    query = location_feed_query(db, latitude, longitude, distance_range)
+    result = query.order_by(desc(Posts.date), desc(Posts.id)).limit(max_posts + 1).all()
+    if len(result) > max_posts:
+        return False
+    return feed_response(db, result)
+
+
+def candidates_page(posts: list, latitude: float, longitude: float, distance_range: int, limit: int,
+                    cursor: Optional[str], order: FeedOrder):
+    """
+        Returns (posts, next cursor) of a page of the location feed cut from the newest first candidates,
+        with the same filter, order and cursors as load_news_feed.
+    """
+    x, y, z = unit_vector(latitude, longitude)
+    min_dot = math.cos(distance_range / EARTH_RADIUS) if distance_range < math.pi * EARTH_RADIUS else None
+    within = []
+    for post in posts:
+        post_x, post_y, post_z = unit_vector(post.latitude, post.longitude)
+        dot = post_x * x + post_y * y + post_z * z
+        if min_dot is None or dot > min_dot:
+            within.append((dot, post))
+
+    try:
+        if order == FeedOrder.nearest_newest:
+            reference, after = datetime.datetime.now(), None
+            if cursor:
+                reference, score, post_id = decode_rank_cursor(cursor)
+                after = (score, post_id)
+            ranked = sorted((EARTH_RADIUS * math.acos(min(1.0, dot)) / distance_range +
+                             (reference - post.date).total_seconds() / settings.FEED_RANK_AGE_SCALE, post.id, post)
+                            for dot, post in within)
+            page = [item for item in ranked if after is None or item[:2] > after][:limit + 1]
+            next_cursor = encode_rank_cursor(reference, *page[limit - 1][:2]) if len(page) > limit else None
+        else:
+            page = [(post.date, post.id, post) for dot, post in within]
+            if cursor:
+                after = decode_cursor(cursor)
+                page = [item for item in page if item[:2] < after]
+            page = page[:limit + 1]
+            next_cursor = encode_cursor(*page[limit - 1][:2]) if len(page) > limit else None
+    except InvalidCursorError:
+        raise HTTPException(
+            status_code=HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="Invalid cursor.",
+        )
+    return [item[2] for item in page[:limit]], next_cursor
+
+
+def location_feed_query(db: Session, latitude: float, longitude: float, distance_range: float):
+    """
+        Returns the query of the feed rows of the posts within distance_range km.
+    """
+    return db.query(Posts.id,
+                    Posts.user_id,
+                    Users.first_name,
+                    Users.last_name,
+                    Posts.latitude,
+                    Posts.longitude,
+                    Posts.category,
+                    Posts.text,
+                    Posts.date
+                    ).join(Users, Users.id == Posts.user_id).filter(
+        *distance_filter(latitude, longitude, distance_range)
+    )
+
+
+def load_news_feed(db: Session, latitude: float, longitude: float, distance_range: int, limit: int,
+                   cursor: Optional[str], order: FeedOrder = FeedOrder.newest):
+    """
+        Returns (posts, next cursor) of a page of the location feed.
+    """
 
     #subquery_lat = db.query(Farms.latitude.label("farm_lat")).filter(Farms.id == farm_id).subquery()
     #subquery_lon = db.query(Farms.longitude.label("farm_lon")).filter(Farms.id == farm_id).subquery()
     #subquery1 = db.query(subquery_lon, subquery_lat, Posts).subquery()
 
-    query = db.query(Posts.id,
-                     Posts.user_id,
-                     Users.first_name,
-                     Users.last_name,
-                     Posts.latitude,
-                     Posts.longitude,
-                     Posts.category,
-                     Posts.text,
-                     Posts.date
-                     ).join(Users, Users.id == Posts.user_id).filter(
-        func.acos(
-            func.cos(func.radians(latitude)) *
-            func.cos(func.radians(Posts.latitude)) *
-            func.cos(func.radians(Posts.longitude) -
-                     func.radians(longitude)) +
-            func.sin(func.radians(latitude)) *
-            func.sin(func.radians(Posts.latitude))
-        ) * 6371 < distance_range
-    ).order_by(desc(Posts.date)).limit(100)
+    query = location_feed_query(db, latitude, longitude, distance_range)
 
     """query = db.query(subquery1.c.farm_lat,
                      subquery1.c.farm_lon,
@@ -86,39 +300,42 @@ def news_feed(distance_range: int,
         ) * 6371 < feed.distance_range
     ).order_by(subquery1.c.date).limit(100)"""
 
-    result = query.all()
-    if not result:
-        raise HTTPException(
-            status_code=HTTP_404_NOT_FOUND,
-            detail="Feed is empty.",
-        )
-    post_list = []
-    for post in result:
-        curr_post = GetFeedResponse(**post)
-        photo_result = db.query(Post_photos.id).filter(
-            Post_photos.post_id == curr_post.id).order_by(
-            Post_photos.id).all()
-        curr_post.photos_id = [photo_result[i]['id'] for i in range(len(photo_result))]
-        post_list.append(curr_post)
+    if order == FeedOrder.nearest_newest:
+        result, next_cursor = ranked_feed_page(query, latitude, longitude, distance_range, limit, cursor)
+    else:
+        result, next_cursor = feed_page(query, Posts.date, Posts.id, limit, cursor, True)
+    return feed_response(db, result), next_cursor
 
-    return post_list
+
+@router.get("/cache_stats", status_code=HTTP_200_OK,
+            summary="Retrieves the feed and image cache counters")
+def get_feed_cache_stats():
+    return {'feed': feed_cache.stats(), 'images': image_cache.stats()}
 
 
 @router.get("/post_pic/{post_pic}", status_code=HTTP_200_OK,
             summary="Retrieves a post picture based on the id.",
             responses={404: {"description": "Post picture was not found."}})
 def get_post_pic(post_pic: int,
+                 request: Request,
+                 size: ImageSize = ImageSize.original,
                  db: Session = Depends(create_connection),
                  user: Users = Depends(auth.get_current_user)):
     """
         Input parameters:
-        - **profile_id**: id of the user
+        - **post_pic**: id of the post picture
+        - **size**: thumb, medium or original
 
         Response values:
-        - binary form of profile picture
+        - binary form of post picture, supports If-None-Match and Range requests
     """
+    # post photos never change, hot ones are served without touching the database
+    cache_key = ('post', post_pic, size)
+    response = cached_image_response(request, cache_key, IMMUTABLE_CACHE_CONTROL)
+    if response is not None:
+        return response
 
-    result = db.query(Post_photos.photo).filter(Post_photos.id == post_pic).first()
+    result = db.query(Post_photos.photo, Post_photos.mime, Post_photos.hash).filter(Post_photos.id == post_pic).first()
 
     if result is None:
         raise HTTPException(
@@ -126,33 +343,40 @@ def get_post_pic(post_pic: int,
             detail=f"Post picture was not found."
         )
 
-    if result[0] is None:
+    if result.photo is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"Post picture was not found."
         )
 
+    path = image_path(result.photo, "Images/Feed")
     try:
-        with open("Images/Feed/" + result[0], "rb") as buffer:
-            image_bytes = buffer.read()
+        mime, hash = result.mime, result.hash
+        if hash is None:
+            # photos uploaded before the hash was recorded
+            mime, hash = file_info(path)
+            db.query(Post_photos).filter(Post_photos.id == post_pic).update({"mime": mime, "hash": hash})
+            db.commit()
+        return serve_image(request, cache_key, path, mime, hash, size, IMMUTABLE_CACHE_CONTROL)
     except FileNotFoundError:
+        released = release_image(db, result.photo, "Images/Feed")
         db.query(Post_photos).filter(Post_photos.id == post_pic).delete()
         db.commit()
+        delete_released(db, [released], "Images/Feed")
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"Post picture was not found."
         )
 
-    # image_type = magic.from_buffer(filter_query[0], mime=True)
-    image_type = Image.open(io.BytesIO(image_bytes)).format.lower()
-    return Response(content=bytes(image_bytes), media_type=f'image/{image_type}')
-
 
 @router.get("/profile_feed/{profile_id}", status_code=HTTP_200_OK,
             response_model=list[GetFeedResponse],
             summary="Retrieves the available posts for a user profile",
             responses={404: {"description": "Profile not found"}})
 def profile_news_feed(profile_id: int,
+                      response: Response,
+                      limit: int = Query(settings.FEED_PAGE_SIZE, ge=1, le=settings.FEED_MAX_PAGE_SIZE),
+                      cursor: Optional[str] = None,
                       user: Users = Depends(auth.get_current_user),
                       db: Session = Depends(create_connection)):
     result = db.query(Users).filter(Users.id == profile_id).first()
@@ -162,57 +386,55 @@ def profile_news_feed(profile_id: int,
             detail="Profile was not found",
         )
     calc = aliased(Posts)
-    result = db.query(calc.id,
-                      calc.user_id,
-                      Users.first_name,
-                      Users.last_name,
-                      calc.latitude,
-                      calc.longitude,
-                      calc.category,
-                      calc.text,
-                      calc.date) \
+    query = db.query(calc.id,
+                     calc.user_id,
+                     Users.first_name,
+                     Users.last_name,
+                     calc.latitude,
+                     calc.longitude,
+                     calc.category,
+                     calc.text,
+                     calc.date) \
         .join(Users, calc.user_id == Users.id) \
-        .filter(calc.user_id == profile_id) \
-        .order_by(calc.date) \
-        .limit(100) \
-        .all()
-
-    post_list = []
-    for post in result:
-        curr_post = GetFeedResponse(**post)
-        photo_result = db.query(Post_photos.id).filter(
-            Post_photos.post_id == curr_post.id).order_by(
-            Post_photos.id).all()
-        curr_post.photos_id = [photo_result[i]['id'] for i in range(len(photo_result))]
-        post_list.append(curr_post)
+        .filter(calc.user_id == profile_id)
+    result, next_cursor = feed_page(query, calc.date, calc.id, limit, cursor, False)
+    if next_cursor:
+        response.headers[NEXT_CURSOR_HEADER] = next_cursor
 
-    return post_list
+    return feed_response(db, result)
 
 
 @router.post("/new_post", status_code=HTTP_200_OK,
              summary="Creates a new post for the current user")
 def new_post(post: NewPost,
+             background_tasks: BackgroundTasks,
              user: Users = Depends(auth.get_current_user),
              db: Session = Depends(create_connection)):
+    unit_x, unit_y, unit_z = unit_vector(post.latitude, post.longitude)
     post = Posts(user_id=user.id,
                  latitude=post.latitude,
                  longitude=post.longitude,
                  category=post.category,
                  text=post.text,
-                 date=datetime.datetime.now())
+                 date=datetime.datetime.now(),
+                 unit_x=unit_x,
+                 unit_y=unit_y,
+                 unit_z=unit_z)
 
     db.add(post)
+    db.flush()
 
-    attributes = db.query(Users_attributes).filter(Users_attributes.user_id == user.id)
-    values = attributes.first()
-    attributes.update({"post_count": values.post_count + 1})
-    db.commit()
-    db.refresh(post)
-
-    # create msg
+    # create msg, the followers are notified by the outbox dispatcher once the post is committed
     title = "New post"
     body = f"{user.first_name}  {user.last_name} has posted about {post.category}, Check it out!"
-    create_and_send_multicast_news(db, user, title, body)
+    db.add(Notification_outbox(post_id=post.id, user_id=user.id, title=title, body=body))
+
+    change_post_count(db, user.id, 1)
+    db.commit()
+    db.refresh(post)
+    feed_cache.invalidate_near(post.latitude, post.longitude)
+    profile_cache.invalidate(user.id)
+    background_tasks.add_task(dispatch_news_outbox)
 
     return {"post_id": post.id}
 
@@ -229,21 +451,30 @@ def new_post_photos(post_id: int,
             status_code=HTTP_404_NOT_FOUND,
             detail="Profile or Post was not found",
         )
-    photos = []
-
-    for photo in files:
-        bytes = check_if_picture(photo)
-
-        letters = string.ascii_letters + string.digits
-        path = ''.join(random.choice(letters) for _ in range(50)) + "." + photo.content_type.split("/")[1]
-
-        with open("Images/Feed/" + path, "wb") as buffer:
-            buffer.write(bytes)
-
-        photos.append(Post_photos(photo=path, post_id=post_id))
+    uploads = []
+    try:
+        for photo in files:
+            uploads.append(receive_picture(photo))
+    except HTTPException:
+        # the photos of a rejected upload are not kept
+        for temp_path, mime, hash in uploads:
+            os.remove(temp_path)
+        raise
 
+    photos = []
+    created_keys = []
+    for temp_path, mime, hash in uploads:
+        key, created = publish_image(db, temp_path, mime, hash)
+        photos.append(Post_photos(photo=key, post_id=post_id, mime=mime, hash=hash))
+        if created:
+            created_keys.append(key)
+
+    location = validation.latitude, validation.longitude
     db.add_all(photos)
     db.commit()
+    feed_cache.invalidate_near(*location)
+    for key in created_keys:
+        submit_variants(image_storage.path(key))
     return
 
 
@@ -265,8 +496,19 @@ def delete_post(post_id: int,
             detail="Cannot delete others post",
         )
 
+    photo_ids = set()
+    released = []
+    for photo in db.query(Post_photos).filter(Post_photos.post_id == post_id).all():
+        if photo.photo:
+            released.append(release_image(db, photo.photo, "Images/Feed"))
+        photo_ids.add(photo.id)
+        db.delete(photo)
+    location = validation.latitude, validation.longitude
     db.delete(validation)
     db.commit()
+    delete_released(db, released, "Images/Feed")
+    feed_cache.invalidate_near(*location)
+    image_cache.invalidate_where(lambda key: key[0] == 'post' and key[1] in photo_ids)
     return
 
 
@@ -304,36 +546,132 @@ def try_notification(profile_id: int,
         )
 
 
-# handle messaging
-def create_and_send_multicast_news(db, user, title, body):
-    followers = db.query(Interactions, Settings.fcm_token, Settings.news_notifications).filter(Interactions.followed_profile == user.id)\
-        .join(Settings, Interactions.follower == Settings.user_id).all()
-    tokens = check_tokens(followers)
-    send_multicast(tokens, title, body)
+# FCM accepts at most 500 registration tokens in one multicast message
+MULTICAST_LIMIT = 500
+
 
+def send_multicast(registration_tokens, title, body):
+    """
+        Sends the notification to all tokens in batches of at most MULTICAST_LIMIT tokens.
+        Returns the tokens that caused failures.
+    """
+    failed_tokens = []
+    for start in range(0, len(registration_tokens), MULTICAST_LIMIT):
+        batch = registration_tokens[start:start + MULTICAST_LIMIT]
+        message = messaging.MulticastMessage(
+            notification=messaging.Notification(
+                title=title,
+                body=body,
+            ),
+            tokens=batch,
+        )
+        response = messaging.send_multicast(message)
+        if response.failure_count > 0:
+            # The order of responses corresponds to the order of the registration tokens.
+            batch_failed = [batch[idx] for idx, resp in enumerate(response.responses) if not resp.success]
+            print('List of tokens that caused failures: {0}'.format(batch_failed))
+            failed_tokens.extend(batch_failed)
+    return failed_tokens
 
-def check_tokens(users_settings):
-    tokens = []
-    for user_settings in users_settings:
-        if user_settings.fcm_token and user_settings.news_notifications:
-            tokens.append(user_settings.fcm_token)
-    return tokens
 
+def dispatch_news_outbox():
+    """
+        Sends the queued follower notifications of new posts, returns the number of delivered notifications.
+        Notifications are claimed with a lease, so several workers can dispatch at the same time
+        and a notification of a crashed worker is picked up again once its lease expires.
+    """
+    return run_with_session(_dispatch_news_outbox)
 
-def send_multicast(registration_tokens, title, body):
-    message = messaging.MulticastMessage(
-        notification=messaging.Notification(
-            title=title,
-            body=body,
-        ),
-        tokens=registration_tokens,
-    )
-    response = messaging.send_multicast(message)
-    if response.failure_count > 0:
-        responses = response.responses
-        failed_tokens = []
-        for idx, resp in enumerate(responses):
-            if not resp.success:
-                # The order of responses corresponds to the order of the registration tokens.
-                failed_tokens.append(registration_tokens[idx])
-        print('List of tokens that caused failures: {0}'.format(failed_tokens))
+
+def _dispatch_news_outbox(db: Session):
+    delivered = 0
+    while True:
+        notifications = claim_news_outbox(db)
+        if not notifications:
+            return delivered
+        for notification in notifications:
+            if deliver_news(db, notification):
+                delivered += 1
+
+
+def claim_news_outbox(db: Session):
+    """
+        Leases a batch of due notifications to this worker and returns them. Notifications whose last
+        allowed attempt ended without a result, e.g. the worker crashed, are dropped.
+    """
+    dropped = db.query(Notification_outbox) \
+        .filter(Notification_outbox.next_attempt <= func.now(),
+                Notification_outbox.attempts >= settings.OUTBOX_MAX_ATTEMPTS) \
+        .delete(synchronize_session=False)
+    if dropped:
+        print(f'{dropped} news notifications were dropped after {settings.OUTBOX_MAX_ATTEMPTS} attempts')
+    rows = db.query(Notification_outbox.id) \
+        .filter(Notification_outbox.next_attempt <= func.now(),
+                Notification_outbox.attempts < settings.OUTBOX_MAX_ATTEMPTS) \
+        .order_by(Notification_outbox.id) \
+        .limit(settings.OUTBOX_BATCH_SIZE) \
+        .with_for_update(skip_locked=True).all()
+    ids = [row.id for row in rows]
+    if ids:
+        db.query(Notification_outbox).filter(Notification_outbox.id.in_(ids)).update({
+            Notification_outbox.attempts: Notification_outbox.attempts + 1,
+            Notification_outbox.next_attempt: func.now() + datetime.timedelta(seconds=settings.OUTBOX_LEASE),
+        }, synchronize_session=False)
+    db.commit()
+    if not ids:
+        return []
+    return db.query(Notification_outbox).filter(Notification_outbox.id.in_(ids)) \
+        .order_by(Notification_outbox.id).all()
+
+
+def news_followers(db: Session, user_id: int, after: int):
+    """
+        Returns the next batch of (follower, fcm_token) of the followers with news notifications,
+        in the order of their ids after the follower id after.
+    """
+    return db.query(Interactions.follower, Settings.fcm_token) \
+        .join(Settings, Interactions.follower == Settings.user_id) \
+        .filter(Interactions.followed_profile == user_id,
+                Interactions.follower > after,
+                Settings.news_notifications.is_(True),
+                Settings.fcm_token.isnot(None),
+                Settings.fcm_token != '') \
+        .order_by(Interactions.follower) \
+        .limit(MULTICAST_LIMIT).all()
+
+
+def deliver_news(db: Session, notification: Notification_outbox):
+    """
+        Sends the notification to the followers of the author in multicast batches.
+        The progress is committed after every batch, a failed notification is retried later
+        from the first follower that was not notified yet and dropped after OUTBOX_MAX_ATTEMPTS attempts.
+        Returns True when it was delivered.
+    """
+    try:
+        while True:
+            followers = news_followers(db, notification.user_id, notification.last_follower)
+            if followers:
+                send_multicast([follower.fcm_token for follower in followers], notification.title, notification.body)
+                notification.last_follower = followers[-1].follower
+            if len(followers) < MULTICAST_LIMIT:
+                db.delete(notification)
+                db.commit()
+                return True
+            # renews the lease with the progress, so a long fan-out is not claimed by another worker
+            notification.next_attempt = func.now() + datetime.timedelta(seconds=settings.OUTBOX_LEASE)
+            db.commit()
+    except Exception as error:
+        # not only firebase errors, one broken notification must not stop the dispatch of the others
+        db.rollback()
+        outbox = db.query(Notification_outbox).filter(Notification_outbox.id == notification.id)
+        if notification.attempts >= settings.OUTBOX_MAX_ATTEMPTS:
+            outbox.delete(synchronize_session=False)
+            print(f'News notification {notification.id} was dropped after {notification.attempts} attempts: {error}')
+        else:
+            delay = settings.OUTBOX_RETRY_DELAY * 2 ** (notification.attempts - 1)
+            outbox.update({
+                Notification_outbox.next_attempt: func.now() + datetime.timedelta(seconds=delay),
+            }, synchronize_session=False)
+            print(f'News notification {notification.id} failed, retrying in {delay} s: {error}')
+        db.commit()
+        return False
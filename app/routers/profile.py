@@ -1,26 +1,29 @@
-import os
-import random
-import string
-
-from fastapi import APIRouter, HTTPException, status, Depends, UploadFile, File
+from fastapi import APIRouter, HTTPException, status, Depends, UploadFile, File, Query
 from sqlalchemy.orm import Session
-from starlette.responses import StreamingResponse, Response
+from starlette.responses import FileResponse
 
 from app.models import Users
 from starlette.status import HTTP_200_OK, HTTP_404_NOT_FOUND, HTTP_422_UNPROCESSABLE_ENTITY
 from typing import List, Optional
 
-import io
-
 from app.db.database import create_connection
 from app.security import auth
 
 from app.schemas.profile_schema import Search_profile, Get_Profile, Like_dislike
-from app.schemas.farms_schema import GetFarms
 from app.miscFunctions.coordinates import check_coors
+from app.miscFunctions.names import normalize_name
+from app.miscFunctions.feed_cache import feed_cache
+from app.miscFunctions.profile_cache import profile_cache
+from app.miscFunctions.counters import change_like_count
+from app.miscFunctions.images import store_upload, file_info, serve_image, cached_image_response, submit_variants, \
+    image_cache, ImageSize, InvalidImageError, ImageTooLargeError, REVALIDATE_CACHE_CONTROL
+from app.miscFunctions.image_storage import image_storage, image_path, publish_image, release_image, \
+    delete_released
+from app.settings import settings
+from starlette.requests import Request
 from app.models import Farms, Users, Users_attributes, Interactions
-from sqlalchemy import func
-from PIL import Image
+from sqlalchemy import func, or_, desc, exists, select, literal_column, delete
+from sqlalchemy.dialects.postgresql import aggregate_order_by, insert
 
 router = APIRouter(
     prefix="/profile",
@@ -33,31 +36,72 @@ router = APIRouter(
             response_model=list[Search_profile],
             summary="Retrieves the available profiles")
 def search_profiles(string: str,
+                    limit: int = Query(settings.PROFILE_SEARCH_LIMIT, ge=1, le=settings.PROFILE_SEARCH_MAX_LIMIT),
                     user: Users = Depends(auth.get_current_user),
                     db: Session = Depends(create_connection)):
+    """
+        Input parameters:
+        - **string**: searched name, case and diacritics are ignored
+        - **limit**: maximal number of profiles
+
+        Response values:
+        - the best matching profiles, names starting with the string first
+
+        Profiles whose first or last name starts with the string are found, with PROFILE_SEARCH_TRIGRAM
+        also the names containing it or similar to it.
+    """
+    name = normalize_name(string)
+    if not name:
+        return []
     query = db.query(Users.first_name,
                      Users.last_name,
                      Users.id)
-    results = query.filter(
-        func.lower(func.concat(func.lower(Users.first_name), ' ', func.lower(Users.last_name))).like(
-            f"%{string.lower()}%")).all()
+    prefix = Users.search_name.startswith(name, autoescape=True)
+    if settings.PROFILE_SEARCH_TRIGRAM:
+        results = query.filter(or_(Users.search_name.contains(name, autoescape=True),
+                                   Users.search_name.op('%')(name))) \
+            .order_by(desc(Users.search_name == name), desc(prefix),
+                      desc(func.similarity(Users.search_name, name)), Users.id)
+    else:
+        results = query.filter(or_(prefix, Users.search_name_reverse.startswith(name, autoescape=True))) \
+            .order_by(desc(Users.search_name == name), desc(prefix), func.length(Users.search_name), Users.id)
 
-    return [Search_profile(**profile) for profile in results]
+    return [Search_profile(**profile) for profile in results.limit(limit).all()]
 
 
 @router.get("/{profile_id}", status_code=HTTP_200_OK,
             response_model=Get_Profile,
             summary="Retrieves the available profile",
             responses={404: {"description": "Profile not found"}})
-def get_profile(profile_id: str,
+def get_profile(profile_id: int,
                 user: Users = Depends(auth.get_current_user),
                 db: Session = Depends(create_connection)):
+    """
+        Response values:
+        - the profile with its farms and whether the current user likes it
+
+        The profile is loaded with one query, its public part is kept in profile_cache
+        and only the interaction is queried for a cached profile.
+    """
+    interaction = exists().where(Interactions.followed_profile == profile_id, Interactions.follower == user.id)
+    public = profile_cache.get(profile_id)
+    if public is not None:
+        return Get_Profile(**public, interaction=db.query(interaction).scalar())
+
+    farms = select(func.coalesce(
+        func.json_agg(aggregate_order_by(
+            func.json_build_object('id', Farms.id, 'name', Farms.name,
+                                   'latitude', Farms.latitude, 'longitude', Farms.longitude),
+            Farms.id)),
+        literal_column("'[]'::json"))).where(Farms.user_id == Users.id).scalar_subquery()
     profile_query = db.query(Users.id,
                              Users.first_name,
                              Users.last_name,
                              Users_attributes.post_count,
                              Users_attributes.like_count,
                              Users.photo.label("picture_path"),
+                             farms.label("farms"),
+                             interaction.label("interaction"),
                              ).filter(Users.id == profile_id).join(Users_attributes).first()
 
     if profile_query is None:
@@ -66,38 +110,31 @@ def get_profile(profile_id: str,
             detail=f"Profile was not found."
         )
 
-    farms_query = db.query(Farms.id,
-                           Farms.name,
-                           Farms.latitude,
-                           Farms.longitude).filter(Farms.user_id == profile_id).all()
-    interaction = db.query(Interactions).filter(Interactions.followed_profile == profile_id,
-                                                Interactions.follower == user.id).first()
-
-    profile = Get_Profile(**profile_query)
-    profile.farms = [GetFarms(**farm) for farm in farms_query]
-    if interaction is None:
-        profile.interaction = False
-    else:
-        profile.interaction = True
+    public = profile_query._asdict()
+    del public['interaction']
+    profile_cache.put(profile_id, public)
     # TODO delete picture path, profile pic is based on ID
-    return profile
+    return Get_Profile(**profile_query)
 
 
 @router.get("/profile_pic/{profile_id}", status_code=HTTP_200_OK,
             summary="Retrieves a profile picture based on the id.",
             responses={404: {"description": "Post picture not found."}})
 def get_profile_pic(profile_id: int,
+                    request: Request,
+                    size: ImageSize = ImageSize.original,
                     db: Session = Depends(create_connection),
                     user: Users = Depends(auth.get_current_user)):
     """
         Input parameters:
         - **profile_id**: id of the user
+        - **size**: thumb, medium or original
 
         Response values:
-        - binary form of profile picture
+        - binary form of profile picture, supports If-None-Match and Range requests
     """
 
-    result = db.query(Users.photo).filter(Users.id == profile_id).first()
+    result = db.query(Users.photo, Users.photo_mime, Users.photo_hash).filter(Users.id == profile_id).first()
 
     if result is None:
         raise HTTPException(
@@ -105,26 +142,36 @@ def get_profile_pic(profile_id: int,
             detail=f"Profile picture was not found."
         )
 
-    if result[0] is None:
+    if result.photo is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"Profile picture was not found."
         )
-    # image_type = magic.from_buffer(filter_query[0], mime=True)
+    # the file of a picture never changes, a new picture gets a new key
+    cache_key = ('profile', result.photo, size)
+    response = cached_image_response(request, cache_key, REVALIDATE_CACHE_CONTROL)
+    if response is not None:
+        return response
+
+    path = image_path(result.photo, "Images/Profile")
     try:
-        with open("Images/Profile/" + result[0], "rb") as buffer:
-            image_bytes = buffer.read()
+        mime, hash = result.photo_mime, result.photo_hash
+        if hash is None:
+            # pictures uploaded before the hash was recorded
+            mime, hash = file_info(path)
+            db.query(Users).filter(Users.id == profile_id).update({"photo_mime": mime, "photo_hash": hash})
+            db.commit()
+        return serve_image(request, cache_key, path, mime, hash, size, REVALIDATE_CACHE_CONTROL)
     except FileNotFoundError:
-        db.query(Users).filter(Users.id == profile_id).update({"photo": None})
+        released = release_profile_pic(db, result.photo)
+        db.query(Users).filter(Users.id == profile_id).update({"photo": None, "photo_mime": None, "photo_hash": None})
         db.commit()
+        delete_released(db, [released], "Images/Profile")
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"Profile picture was not found."
         )
 
-    image_type = Image.open(io.BytesIO(image_bytes)).format.lower()
-    return Response(content=bytes(image_bytes), media_type=f'image/{image_type}')
-
     # image_type = Image.open(io.BytesIO(result[0])).format.lower()
     # return Response(content=bytes(result[0]), media_type=f'image/{image_type}')
 
@@ -137,16 +184,21 @@ def delete_profile(user: Users = Depends(auth.get_current_user),
     query = db.query(Users).filter(Users.id == user.id).first()
     if query:
 
-        # likes and dislikes should be corrected
-        followed_profiles = db.query(Interactions).filter(Interactions.follower == user.id).all()
+        # likes and dislikes should be corrected, only for the likes this request removes
+        followed_profiles = db.execute(delete(Interactions).where(Interactions.follower == user.id)
+                                       .returning(Interactions.followed_profile)).all()
         for followed_profile in followed_profiles:
-            profile = db.query(Users_attributes).filter(
-                Users_attributes.user_id == followed_profile.followed_profile)
-            profile.update({'like_count': profile.first().like_count - 1})
-            db.commit()
+            change_like_count(db, followed_profile.followed_profile, -1)
 
+        released = release_profile_pic(db, query.photo) if query.photo else None
         db.delete(query)
         db.commit()
+        delete_released(db, [released], "Images/Profile")
+        profile_cache.invalidate(user.id)
+        for followed_profile in followed_profiles:
+            profile_cache.invalidate(followed_profile.followed_profile)
+        # the posts of the profile leave the feed
+        feed_cache.clear()
         return True
     else:
         raise HTTPException(
@@ -155,7 +207,19 @@ def delete_profile(user: Users = Depends(auth.get_current_user),
         )
 
 
-def check_if_picture(file: UploadFile = File(...)):
+def release_profile_pic(db: Session, photo: str):
+    """
+        Drops the reference of the profile to its picture and removes the picture from the image cache.
+        Returns the key to pass to delete_released after the commit like release_image.
+    """
+    image_cache.invalidate_where(lambda key: key[0] == 'profile' and key[1] == photo)
+    return release_image(db, photo, "Images/Profile")
+
+
+def receive_picture(file: UploadFile):
+    """
+        Streams an uploaded picture into a temporary file of the image storage, returns (temporary path, mime, hash).
+    """
     # check_filetype
     supported_files = ["image/jpeg", "image/jpg", "image/png"]
     if file.content_type not in supported_files:
@@ -163,14 +227,19 @@ def check_if_picture(file: UploadFile = File(...)):
             status_code=HTTP_422_UNPROCESSABLE_ENTITY,
             detail="Unsupported file type.",
         )
-    file_bytes = file.file.read()
-    size = len(file_bytes)
-    if size > 10 * 1024 * 1024:  # 3MB = 3*1024 KB = 3* 1024 * 1024
+    temp_path = image_storage.temp_path()
+    try:
+        return (temp_path,) + store_upload(file.file, temp_path, settings.IMAGE_MAX_UPLOAD_SIZE)
+    except InvalidImageError:
+        raise HTTPException(
+            status_code=HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="Unsupported file type.",
+        )
+    except ImageTooLargeError:
         raise HTTPException(
             status_code=HTTP_422_UNPROCESSABLE_ENTITY,
             detail="Selected file is too large.",
         )
-    return file_bytes
 
 
 @router.put("/pic", status_code=HTTP_200_OK,
@@ -187,23 +256,19 @@ def modify_profile_pic(file: UploadFile = File(...),
             status_code=HTTP_404_NOT_FOUND,
             detail="Profile was not found.",
         )
-    file_bytes = check_if_picture(file)
-
-    letters = string.ascii_letters + string.digits
-    path = ''.join(random.choice(letters) for _ in range(50)) + "." + file.content_type.split("/")[1]
-
-    # TODO check if path exists
+    temp_path, mime, hash = receive_picture(file)
+    key, created = publish_image(db, temp_path, mime, hash)
 
-    if query_row.photo:
-        os.remove("Images/Profile/" + query_row.photo)
+    released = release_profile_pic(db, query_row.photo) if query_row.photo else None
 
-    with open("Images/Profile/" + path, "wb") as buffer:
-        buffer.write(file_bytes)
-
-    query.update({"photo": path})
+    query.update({"photo": key, "photo_mime": mime, "photo_hash": hash})
     # query.update({"photo": file_bytes})
     db.commit()
-    return StreamingResponse(io.BytesIO(file_bytes), media_type=file.content_type)
+    delete_released(db, [released], "Images/Profile")
+    profile_cache.invalidate(user.id)
+    if created:
+        submit_variants(image_storage.path(key))
+    return FileResponse(image_storage.path(key), media_type=mime)
 
 
 @router.put("/delete_pic", status_code=HTTP_200_OK,
@@ -232,16 +297,17 @@ def delete_profile_pic(db: Session = Depends(create_connection),
             detail="Not authorized to perform this action."
         )
 
-    if os.path.exists("Images/Profile/" + query_row.photo):
-        os.remove("Images/Profile/" + query_row.photo)
-    else:
+    if not query_row.photo:
         raise HTTPException(
             status_code=HTTP_404_NOT_FOUND,
             detail="Profile picture was not found.",
         )
+    released = release_profile_pic(db, query_row.photo)
 
-    query.update({"photo": None})
+    query.update({"photo": None, "photo_mime": None, "photo_hash": None})
     db.commit()
+    delete_released(db, [released], "Images/Profile")
+    profile_cache.invalidate(user.id)
 
     return {"photo": None}
 
@@ -258,21 +324,20 @@ def like_dislike(like_dislike: Like_dislike,
             status_code=HTTP_404_NOT_FOUND,
             detail="Profile was not found.",
         )
-    query = db.query(Interactions).filter(Interactions.follower == user.id,
-                                          Interactions.followed_profile == like_dislike.profile_id)
-    result = query.first()
-    attributes = db.query(Users_attributes).filter(Users_attributes.user_id == like_dislike.profile_id)
-    attr_value = attributes.first()
-    if result and like_dislike.interaction is False:
-        # it exists
-        attributes.update({'like_count': attr_value.like_count - 1})
-
-        db.delete(result)
-        db.commit()
-    elif not result and like_dislike.interaction is True:
-        # need to create new relation
-        relation = Interactions(follower=user.id, followed_profile=like_dislike.profile_id)
-        attributes.update({'like_count': attr_value.like_count + 1})
-        db.add(relation)
-        db.commit()
-        db.refresh(relation)
+    # the like count only changes together with the interaction, concurrent requests can not count twice
+    if like_dislike.interaction is False:
+        changed = db.execute(delete(Interactions).where(Interactions.follower == user.id,
+                                                        Interactions.followed_profile == like_dislike.profile_id)
+                             .returning(Interactions.follower)).first()
+        delta = -1
+    elif like_dislike.interaction is True:
+        changed = db.execute(insert(Interactions).values(follower=user.id, followed_profile=like_dislike.profile_id)
+                             .on_conflict_do_nothing().returning(Interactions.follower)).first()
+        delta = 1
+    else:
+        return
+    if changed:
+        change_like_count(db, like_dislike.profile_id, delta)
+    db.commit()
+    if changed:
+        profile_cache.invalidate(like_dislike.profile_id)
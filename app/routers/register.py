@@ -3,8 +3,10 @@ from starlette.status import HTTP_201_CREATED, HTTP_403_FORBIDDEN
 from ..models import Users, Settings, Users_attributes
 from ..schemas.register_login_schema import PostRegister, UserRegister
 from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 from ..security.passwords import get_password_hash
+from ..miscFunctions.names import normalize_name
 from ..db.database import create_connection
 import re
 
@@ -116,9 +118,19 @@ async def register(user: UserRegister, db: Session = Depends(create_connection))
     )
     """
 
-    registered_user = Users(**user.dict())  # wrap json into the model object
+    registered_user = Users(**user.dict(),
+                            search_name=normalize_name(user.first_name, user.last_name),
+                            search_name_reverse=normalize_name(user.last_name, user.first_name))
     db.add(registered_user)
-    db.commit()
+    try:
+        db.commit()
+    except IntegrityError:
+        # the same email was registered since the check above
+        db.rollback()
+        raise HTTPException(
+            status_code=HTTP_403_FORBIDDEN,
+            detail="Email already taken.",
+        )
     db.refresh(registered_user)
     db.flush()
     user_id = db.query(Users.id).filter(Users.email == user.email).first()
@@ -1,24 +1,37 @@
-from enum import Enum
+import asyncio
+import datetime
+import time
 
 from fastapi import APIRouter, HTTPException, status, Depends
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import Session, sessionmaker
 
 from app.db import init_db
-from app.models import Users, Farms, Settings
-from starlette.status import HTTP_200_OK
+from app.models import Users, Farms, Settings, WeatherType
+from starlette.status import HTTP_200_OK, HTTP_422_UNPROCESSABLE_ENTITY
 from typing import List, Optional
 
-from app.db.database import create_connection
-from app.routers.feed import check_tokens, send_multicast
+from app.db.database import create_connection, run_with_session
+from app.routers.feed import send_multicast, MULTICAST_LIMIT
 from app.security import auth
 
-from app.schemas.weather_schema import CurrentResponse, HourlyResponse, WeatherVariables, WeatherPydantic, \
-    WeatherLocation, SearchResponse, DailyResponse, WeatherVariablesDaily
+from app.schemas.weather_schema import CurrentResponse, HourlyResponse, WeatherLocation, SearchResponse, \
+    DailyResponse, BulkLocation
+
+import httpx
+from starlette.concurrency import run_in_threadpool
 
-import requests
 from app.settings import settings
+from app.miscFunctions.http_client import get_client
 
-from app.miscFunctions.coordinates import check_coors
+from app.miscFunctions.coordinates import check_coors, quantize, cell_center
+from app.miscFunctions.cache import TTLCache
+from app.miscFunctions.single_flight import SingleFlight
+from app.miscFunctions.circuit_breaker import CircuitBreaker
+from app.miscFunctions.search_cache import SearchCache, Pacer, QueueFullError, normalize_query
+from app.miscFunctions import weather_store
+from app.miscFunctions.weather_extract import extract_weather, extract_city, extract_variables, \
+    extract_variables_daily
 
 router = APIRouter(
     prefix="/weather",
@@ -26,198 +39,386 @@ router = APIRouter(
 )
 
 
-class WeatherType(Enum):
-    Current = 1
-    Hourly = 2
-    Daily = 3
+WEATHER_TTL = {
+    WeatherType.Current: settings.WEATHER_CURRENT_TTL,
+    WeatherType.Hourly: settings.WEATHER_HOURLY_TTL,
+    WeatherType.Daily: settings.WEATHER_DAILY_TTL,
+}
 
+# parsed weather responses keyed by (WeatherType, grid cell), expired ones are kept to be served as stale
+weather_cache = TTLCache(maxsize=settings.WEATHER_CACHE_SIZE, ttl=settings.WEATHER_CURRENT_TTL,
+                         stale_ttl=settings.WEATHER_STALE_TTL)
+weather_breaker = CircuitBreaker(failure_threshold=settings.WEATHER_BREAKER_FAILURES,
+                                 reset_timeout=settings.WEATHER_BREAKER_RESET_TIMEOUT)
+# concurrent cache misses of the same key share one upstream call
+weather_flight = SingleFlight()
+upstream_stats = {'calls': 0, 'errors': 0}
+
+# location searches, Nominatim allows one request per second
+search_cache = SearchCache(maxsize=settings.SEARCH_CACHE_SIZE, ttl=settings.SEARCH_CACHE_TTL,
+                           prefix_min_length=settings.SEARCH_PREFIX_MIN_LENGTH)
+search_flight = SingleFlight()
+nominatim_pacer = Pacer(interval=settings.NOMINATIM_MIN_INTERVAL, max_waiting=settings.SEARCH_QUEUE_SIZE)
 
-def flatten_dict(d, parent_key='', sep='_'):
-    items = []
-    for k, v in d.items():
-        new_key = parent_key + sep + k if parent_key else k
-        if isinstance(v, list):
-            for elem in v:
-                items.extend(flatten_dict(elem, new_key, sep=sep).items())
-        elif isinstance(v, dict):
-            items.extend(flatten_dict(v, new_key, sep=sep).items())
-        else:
-            items.append((new_key, v))
-    return dict(items)
 
+OPENWEATHER_URLS = {
+    WeatherType.Current: ("https://api.openweathermap.org", "/data/2.5/weather", {}),
+    WeatherType.Hourly: ("https://pro.openweathermap.org", "/data/2.5/forecast/hourly", {'cnt': 24}),
+    WeatherType.Daily: ("https://api.openweathermap.org", "/data/2.5/forecast/daily", {'cnt': 16}),
+}
 
-def get_OpenWeather(lat: float, long: float, type=WeatherType.Current):
+
+async def get_OpenWeather(lat: float, long: float, type=WeatherType.Current):
     check_coors(long, lat)
+    if not weather_breaker.allow():
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail="OpenWeatherMap is temporarily unavailable")
+    probe = weather_breaker.state == CircuitBreaker.HALF_OPEN
+    base_url, path, extra_params = OPENWEATHER_URLS[type]
+    params = {'lat': lat, 'lon': long, 'appid': settings.OPENWEATHERMAP_KEY, 'units': 'metric', **extra_params}
+    upstream_stats['calls'] += 1
     try:
-        if type == WeatherType.Current:
-            response = requests.get(
-                f"https://api.openweathermap.org/data/2.5/weather?lat={lat}&lon={long}&appid={settings.OPENWEATHERMAP_KEY}&units=metric")
-        elif type == WeatherType.Hourly:
-            response = requests.get(
-                f"https://pro.openweathermap.org/data/2.5/forecast/hourly?lat={lat}&lon={long}&appid={settings.OPENWEATHERMAP_KEY}&units=metric&cnt=24")
-        else:
-            response = requests.get(
-                f"https://api.openweathermap.org/data/2.5/forecast/daily?lat={lat}&lon={long}&appid={settings.OPENWEATHERMAP_KEY}&units=metric&cnt=16")
-
+        response = await get_client(base_url).get(path, params=params)
         response.raise_for_status()
         weather_data = response.json()
+        weather_breaker.record_success()
         return weather_data
-    except requests.exceptions.HTTPError as errh:
+    except httpx.HTTPStatusError as errh:
+        upstream_stats['errors'] += 1
+        # only server side errors mean the upstream is unhealthy
+        if errh.response.status_code >= 500 or errh.response.status_code == 429:
+            weather_breaker.record_failure()
+        else:
+            weather_breaker.record_success()
         raise HTTPException(status_code=500, detail="OpenWeatherMap API Error")
-    except requests.exceptions.ConnectionError as errc:
+    except httpx.ConnectError as errc:
+        upstream_stats['errors'] += 1
+        weather_breaker.record_failure()
         raise HTTPException(status_code=500, detail="Error Connecting")
-    except requests.exceptions.Timeout as errt:
+    except httpx.TimeoutException as errt:
+        upstream_stats['errors'] += 1
+        weather_breaker.record_failure()
         raise HTTPException(status_code=500, detail="Timeout Error")
-    except requests.exceptions.RequestException as err:
+    except httpx.HTTPError as err:
+        upstream_stats['errors'] += 1
+        weather_breaker.record_failure()
         raise HTTPException(status_code=500, detail="Something went wrong")
+    except ValueError:
+        # a response body which is not JSON
+        upstream_stats['errors'] += 1
+        weather_breaker.record_failure()
+        raise HTTPException(status_code=500, detail="OpenWeatherMap API Error")
+    finally:
+        # a probe ending any other way, e.g. cancelled, must not keep the circuit half open
+        if probe:
+            weather_breaker.release()
+
+
+def parse_curr_weather(data: dict):
+    return {'weather': extract_weather(data), 'variables': extract_variables(data)}
+
+
+def parse_hourly_weather(data: dict):
+    return {'weather': extract_city(data), 'variables': [extract_variables(item) for item in data['list']]}
+
+
+def parse_daily_weather(data: dict):
+    return {'weather': extract_city(data), 'variables': [extract_variables_daily(item) for item in data['list']]}
+
+
+WEATHER_PARSERS = {
+    WeatherType.Current: parse_curr_weather,
+    WeatherType.Hourly: parse_hourly_weather,
+    WeatherType.Daily: parse_daily_weather,
+}
 
 
-def get_keys_values(variables, key, dict):
+def weather_key(type: WeatherType, lat: float, long: float):
+    """
+        Cache key of a location, nearby coordinates share the same grid cell.
+    """
+    return (type,) + quantize(lat, long, settings.WEATHER_GRID_SIZE)
+
+
+async def fetch_weather(key: tuple):
+    """
+        Returns the stored snapshot of the key's grid cell when it is fresh enough, otherwise calls
+        upstream for the center of the cell and stores the parsed result. The result is cached in memory.
+    """
+    type = key[0]
+    cell_lat, cell_long = cell_center(key[1:], settings.WEATHER_GRID_SIZE)
+    stored = await load_snapshot(type, cell_lat, cell_long, WEATHER_TTL[type])
+    if stored is not None:
+        result, refresh_time = stored
+        age = (datetime.datetime.utcnow() - refresh_time).total_seconds()
+        weather_cache.put(key, result, ttl=WEATHER_TTL[type] - age)
+        return result
+    return await refresh_weather(key)
+
+
+async def refresh_weather(key: tuple):
+    """
+        Calls upstream for the center of the key's grid cell, stores and caches the parsed result.
+    """
+    type = key[0]
+    cell_lat, cell_long = cell_center(key[1:], settings.WEATHER_GRID_SIZE)
+    result = WEATHER_PARSERS[type](await get_OpenWeather(cell_lat, cell_long, type=type))
+    await save_snapshot(type, cell_lat, cell_long, result)
+    weather_cache.put(key, result, ttl=WEATHER_TTL[type])
+    return result
+
+
+async def load_snapshot(type: WeatherType, cell_lat: float, cell_long: float, max_age: float):
+    """
+        Returns the stored snapshot of the grid cell like weather_store.load_snapshot,
+        or None when the database fails, the weather is then served from upstream.
+    """
+    try:
+        return await run_in_threadpool(run_with_session, weather_store.load_snapshot,
+                                       type, cell_lat, cell_long, max_age)
+    except SQLAlchemyError as error:
+        print(f'Loading the weather snapshot of {cell_lat}, {cell_long} failed: {error}')
+        return None
+
+
+async def save_snapshot(type: WeatherType, cell_lat: float, cell_long: float, result: dict):
+    """
+        Stores the snapshot of the grid cell, a failure is only reported, the result is served anyway.
+    """
+    try:
+        await run_in_threadpool(run_with_session, weather_store.save_snapshot, type, cell_lat, cell_long, result)
+    except SQLAlchemyError as error:
+        print(f'Storing the weather snapshot of {cell_lat}, {cell_long} failed: {error}')
+
+
+def mark_stale(result: dict):
+    return {**result, 'stale': True}
+
+
+async def get_weather(type: WeatherType, lat: float, long: float):
+    """
+        Returns parsed weather for the grid cell of the given location.
+        Upstream is only called when the cell is not cached, concurrent misses of the same cell wait
+        for a single upstream call. Expired results are served marked as stale while they are refreshed
+        in the background, and the last stored snapshot is served when upstream fails or its circuit is open.
+    """
+    check_coors(long, lat)
+    key = weather_key(type, lat, long)
+    result, stale = weather_cache.get_stale(key)
+    if result is not None:
+        if stale:
+            weather_flight.start(key, lambda: fetch_weather(key))
+            return mark_stale(result)
+        return result
     try:
-        variables[key] = dict.get(key, 0)
-    except Exception:
-        variables[key] = dict.get(key, '')
-    return variables
-
-
-def create_dict_curr_weather(lat: float, long: float):
-    data = get_OpenWeather(lat, long, type=WeatherType.Current)
-    flattened = flatten_dict(data)
-
-    weather = {}
-    variables = {}
-
-    for key in WeatherVariables.__fields__.keys():
-        get_keys_values(variables, key, flattened)
-
-    for key in WeatherPydantic.__fields__.keys():
-        get_keys_values(weather, key, flattened)
-    return {'weather': weather, 'variables': variables}
-
-
-def create_dict_hourly_weather(lat: float, long: float):
-    data = get_OpenWeather(lat, long, type=WeatherType.Hourly)
-    weather = {}
-    variables = []
-    for i in range(len(data['list'])):
-        flattened = flatten_dict(data['list'][i])
-        variables.append({})
-        for key in WeatherVariables.__fields__.keys():
-            get_keys_values(variables[i], key, flattened)
-
-    data['sys'] = data['city']
-    del data['city']
-    flattened = flatten_dict(data)
-    for key in WeatherPydantic.__fields__.keys():
-        get_keys_values(weather, key, flattened)
-
-    # some keys have sys in them, we need to delete them
-    bad_keys = {'sys_name': 'name', 'sys_coord_lat': 'coord_lat',
-                'sys_coord_lon': 'coord_lon', 'sys_timezone': 'timezone'}
-    for key in bad_keys.keys():
-        try:
-            weather[bad_keys[key]] = flattened.get(key, 0)
-        except Exception:
-            weather[bad_keys[key]] = flattened.get(key, '')
-
-    return {'weather': weather, 'variables': variables}
-
-
-def create_dict_daily_weather(lat: float, long: float):
-    data = get_OpenWeather(lat, long, type=WeatherType.Daily)
-    weather = {}
-    variables = []
-    for i in range(len(data['list'])):
-        flattened = flatten_dict(data['list'][i])
-        variables.append({})
-        for key in WeatherVariablesDaily.__fields__.keys():
-            get_keys_values(variables[i], key, flattened)
-
-    data['sys'] = data['city']
-    del data['city']
-    flattened = flatten_dict(data)
-    for key in WeatherPydantic.__fields__.keys():
-        get_keys_values(weather, key, flattened)
-
-    # some keys have sys in them, we need to delete them
-    bad_keys = {'sys_name': 'name', 'sys_coord_lat': 'coord_lat',
-                'sys_coord_lon': 'coord_lon', 'sys_timezone': 'timezone'}
-    for key in bad_keys.keys():
-        try:
-            weather[bad_keys[key]] = flattened.get(key, 0)
-        except Exception:
-            weather[bad_keys[key]] = flattened.get(key, '')
-
-    return {'weather': weather, 'variables': variables}
-
-
-def get_Nominatim(search_string: str):
+        return await weather_flight.do(key, lambda: fetch_weather(key))
+    except HTTPException:
+        cell_lat, cell_long = cell_center(key[1:], settings.WEATHER_GRID_SIZE)
+        stored = await load_snapshot(type, cell_lat, cell_long, settings.WEATHER_STALE_TTL)
+        if stored is None:
+            raise
+        return mark_stale(stored[0])
+
+
+async def fetch_many(type: WeatherType, locations: dict, concurrency: int):
+    """
+        Fetches weather for every location of the dict {key: (lat, long)}, at most
+        concurrency upstream calls run at once. Returns {key: result}, failed locations are left out.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def fetch(key, lat, long):
+        async with semaphore:
+            try:
+                return key, await get_weather(type, lat, long)
+            except HTTPException:
+                return key, None
+
+    results = await asyncio.gather(*[fetch(key, lat, long) for key, (lat, long) in locations.items()])
+    return {key: result for key, result in results if result is not None}
+
+
+async def create_dict_curr_weather(lat: float, long: float):
+    return await get_weather(WeatherType.Current, lat, long)
+
+
+async def create_dict_hourly_weather(lat: float, long: float):
+    return await get_weather(WeatherType.Hourly, lat, long)
+
+
+async def create_dict_daily_weather(lat: float, long: float):
+    return await get_weather(WeatherType.Daily, lat, long)
+
+
+async def get_Nominatim(search_string: str):
     if len(search_string) < 1:
         raise HTTPException(status_code=500, detail="Search string not correct")
+    params = {'q': search_string, 'format': 'json', 'accept-language': 'en', 'limit': settings.NOMINATIM_LIMIT}
     try:
-        response = requests.get(
-            f"https://nominatim.openstreetmap.org/search?q={search_string}&format=json&accept-language=en")
+        response = await get_client("https://nominatim.openstreetmap.org").get("/search", params=params)
         response.raise_for_status()
         search_data = response.json()
         return search_data
-    except requests.exceptions.HTTPError as errh:
+    except httpx.HTTPStatusError as errh:
         raise HTTPException(status_code=500, detail="Nominatim API Error")
-    except requests.exceptions.ConnectionError as errc:
+    except httpx.ConnectError as errc:
         raise HTTPException(status_code=500, detail="Error Connecting")
-    except requests.exceptions.Timeout as errt:
+    except httpx.TimeoutException as errt:
         raise HTTPException(status_code=500, detail="Timeout Error")
-    except requests.exceptions.RequestException as err:
+    except httpx.HTTPError as err:
         raise HTTPException(status_code=500, detail="Something went wrong")
 
 
 @router.get("/curr/{lat}/{long}", response_model=CurrentResponse, status_code=HTTP_200_OK,
             summary="Retrieves current weather for a given location.",
             responses={404: {"description": "Location not found"}})
-def get_curr_weather(lat: float,
-                     long: float,
-                     # user: Users = Depends(auth.get_current_user),
-                     db: Session = Depends(create_connection)):
-    return create_dict_curr_weather(lat, long)
+async def get_curr_weather(lat: float,
+                           long: float,
+                           # user: Users = Depends(auth.get_current_user)
+                           ):
+    return await create_dict_curr_weather(lat, long)
 
 
 @router.get("/hourly/{lat}/{long}", response_model=HourlyResponse, status_code=HTTP_200_OK,
             summary="Retrieves hourly weather for a given location.",
             responses={404: {"description": "Location not found"}})
-def get_hourly_weather(lat: float,
-                       long: float,
-                       # user: Users = Depends(auth.get_current_user),
-                       db: Session = Depends(create_connection)):
-    return create_dict_hourly_weather(lat, long)
+async def get_hourly_weather(lat: float,
+                             long: float,
+                             # user: Users = Depends(auth.get_current_user)
+                             ):
+    return await create_dict_hourly_weather(lat, long)
 
 
 @router.get("/daily/{lat}/{long}", response_model=DailyResponse, status_code=HTTP_200_OK,
             summary="Retrieves daily weather for a given location.",
             responses={404: {"description": "Location not found"}})
-def get_daily_weather(lat: float,
-                      long: float,
-                      # user: Users = Depends(auth.get_current_user),
-                      db: Session = Depends(create_connection)):
-    return create_dict_daily_weather(lat, long)
+async def get_daily_weather(lat: float,
+                            long: float,
+                            # user: Users = Depends(auth.get_current_user)
+                            ):
+    return await create_dict_daily_weather(lat, long)
+
+
+def load_user_farms(db: Session, user_id: int):
+    farms = db.query(Farms.id,
+                     Farms.latitude,
+                     Farms.longitude).filter(Farms.user_id == user_id).all()
+    return [BulkLocation(id=farm.id, latitude=farm.latitude, longitude=farm.longitude) for farm in farms]
+
+
+async def bulk_weather(type: WeatherType, locations: Optional[list[BulkLocation]], user: Users, db: Session):
+    """
+        Returns {location id: weather} for the given locations, or for all farms of the user when
+        no locations are given. Every grid cell is fetched once and the cells are fetched concurrently.
+    """
+    if not locations:
+        locations = await run_in_threadpool(load_user_farms, db, user.id)
+    if len(locations) > settings.BULK_WEATHER_MAX_LOCATIONS:
+        raise HTTPException(
+            status_code=HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"At most {settings.BULK_WEATHER_MAX_LOCATIONS} locations can be requested at once."
+        )
+
+    cells = {}
+    for location in locations:
+        check_coors(location.longitude, location.latitude)
+        key = weather_key(type, location.latitude, location.longitude)
+        cells.setdefault(key, []).append(location)
+
+    results = await fetch_many(type,
+                               {key: (cell[0].latitude, cell[0].longitude) for key, cell in cells.items()},
+                               settings.BULK_WEATHER_CONCURRENCY)
+    return {location.id: results[key] for key, cell in cells.items() if key in results for location in cell}
+
+
+@router.post("/bulk/curr", response_model=dict[int, CurrentResponse], status_code=HTTP_200_OK,
+             summary="Retrieves current weather for several locations, or all farms of the current user.",
+             responses={404: {"description": "Location not found"}})
+async def get_bulk_curr_weather(locations: Optional[list[BulkLocation]] = None,
+                                user: Users = Depends(auth.get_current_user),
+                                db: Session = Depends(create_connection)):
+    """
+        Input parameters:
+        - **locations**: list of id, latitude and longitude, when empty the farms of the user are used
+
+        Response values:
+        - current weather keyed by the location (farm) id, locations which failed are left out
+    """
+    return await bulk_weather(WeatherType.Current, locations, user, db)
+
+
+@router.post("/bulk/daily", response_model=dict[int, DailyResponse], status_code=HTTP_200_OK,
+             summary="Retrieves daily weather for several locations, or all farms of the current user.",
+             responses={404: {"description": "Location not found"}})
+async def get_bulk_daily_weather(locations: Optional[list[BulkLocation]] = None,
+                                 user: Users = Depends(auth.get_current_user),
+                                 db: Session = Depends(create_connection)):
+    """
+        Input parameters:
+        - **locations**: list of id, latitude and longitude, when empty the farms of the user are used
+
+        Response values:
+        - daily weather keyed by the location (farm) id, locations which failed are left out
+    """
+    return await bulk_weather(WeatherType.Daily, locations, user, db)
+
+
+def parse_search(data: list):
+    result = []
+    seen = set()
+    for item in data:
+        location = {key: item.get(key, None) for key in SearchResponse.__fields__.keys()}
+        # check for duplicate
+        if (location['type'], location['display_name']) in seen:
+            continue
+        seen.add((location['type'], location['display_name']))
+        result.append(location)
+    return result
+
+
+async def fetch_search(query: str):
+    """
+        Calls Nominatim through the paced queue, so the upstream rate limit is respected.
+    """
+    try:
+        await nominatim_pacer.wait()
+    except QueueFullError:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail="Location search is busy, try again later")
+    data = await get_Nominatim(query)
+    result = parse_search(data)
+    # a response shorter than the limit holds every match, so longer queries can be answered from it
+    search_cache.put(query, result, complete=len(data) < settings.NOMINATIM_LIMIT)
+    return result
+
+
+async def search_location(string: str):
+    """
+        Returns the locations matching the search string, from the cache when possible.
+    """
+    query = normalize_query(string)
+    result = search_cache.get(query)
+    if result is None:
+        result = search_cache.get_prefix(query)
+    if result is None:
+        result = await search_flight.do(query, lambda: fetch_search(query))
+    return result
 
 
 @router.get("/search/{string}", response_model=list[SearchResponse], status_code=HTTP_200_OK,
             summary="Retrieves the location from text search",
             responses={404: {"description": "Location not found"}})
-def get_search_location(string: str,
-                        db: Session = Depends(create_connection)):
-    data = get_Nominatim(string)
-    result = []
-    for item in data:
-        result.append({})
-        for key in SearchResponse.__fields__.keys():
-            result[len(result) - 1][key] = item.get(key, None)
-        # check for duplicate
-        for dictionary in result[:len(result) - 1]:
-            if result[len(result) - 1]['type'] == dictionary['type'] \
-                    and result[len(result) - 1]['display_name'] == dictionary['display_name']:
-                result.pop(len(result) - 1)
-                break
-    return result
+async def get_search_location(string: str):
+    return await search_location(string)
+
+
+@router.get("/cache_stats", status_code=HTTP_200_OK,
+            summary="Retrieves the weather and search cache counters")
+def get_cache_stats():
+    return {'cache': weather_cache.stats(), 'single_flight': weather_flight.stats(), 'upstream': upstream_stats,
+            'circuit_breaker': weather_breaker.stats(),
+            'search': {'cache': search_cache.stats(), 'single_flight': search_flight.stats(),
+                       'queue': nominatim_pacer.stats()}}
 
 
 """@router.get("/alert", status_code=HTTP_200_OK,
@@ -225,21 +426,122 @@ def get_search_location(string: str,
 def get_search_location(db: Session = Depends(create_connection)):"""
 
 
-def get_alert():
+def load_alert_subscribers():
+    """
+        Streams the Farms x Settings join and groups the FCM tokens by the alert grid cell of the farm.
+        Returns {cell: set of tokens}.
+    """
     SessionLocal = sessionmaker(autocommit=False, bind=init_db.engine)
     db = SessionLocal()
+    subscribers = {}
     try:
-        coordinates_set = set()
-        query = db.query(Farms.latitude, Farms.longitude, Settings.fcm_token, Settings.news_notifications) \
-            .join(Settings, Settings.user_id == Farms.user_id).all()
+        query = db.query(Farms.latitude, Farms.longitude, Settings.fcm_token) \
+            .join(Settings, Settings.user_id == Farms.user_id) \
+            .filter(Settings.news_notifications.is_(True),
+                    Settings.fcm_token.isnot(None),
+                    Settings.fcm_token != '') \
+            .yield_per(settings.ALERT_YIELD_PER)
         for result in query:
-            if result.fcm_token and result.news_notifications:
-                weather_forecast = create_dict_daily_weather(result.latitude, result.longitude)
-                title = "Tomorrow in " + weather_forecast['weather']['name'] + " : " + \
-                        weather_forecast['variables'][1]['weather_description'].capitalize()
-                body = "Temperature will be " + str(weather_forecast['variables'][1]['temp_day']) + "°C" + "\n" + \
-                       "At night will be " + str(weather_forecast['variables'][1]['temp_night']) + "°C"
-                send_multicast([result.fcm_token], title, body)
-            continue
+            cell = quantize(result.latitude, result.longitude, settings.ALERT_GRID_SIZE)
+            subscribers.setdefault(cell, set()).add(result.fcm_token)
+        return subscribers
     finally:
         db.close()
+
+
+def alert_message(weather_forecast: dict):
+    """
+        Creates the title and body of tomorrow's forecast notification.
+    """
+    title = "Tomorrow in " + weather_forecast['weather']['name'] + " : " + \
+            weather_forecast['variables'][1]['weather_description'].capitalize()
+    body = "Temperature will be " + str(weather_forecast['variables'][1]['temp_day']) + "°C" + "\n" + \
+           "At night will be " + str(weather_forecast['variables'][1]['temp_night']) + "°C"
+    return title, body
+
+
+async def get_alert():
+    """
+        Sends tomorrow's forecast to every subscribed farm owner.
+        Every unique location is fetched once and the forecast is fanned out to all subscribers of the cell.
+    """
+    start = time.monotonic()
+    upstream_calls = upstream_stats['calls']
+
+    subscribers = await run_in_threadpool(load_alert_subscribers)
+    locations = {cell: cell_center(cell, settings.ALERT_GRID_SIZE) for cell in subscribers}
+    forecasts = await fetch_many(WeatherType.Daily, locations, settings.ALERT_CONCURRENCY)
+
+    # recipients of identical notifications are sent together
+    messages = {}
+    for cell, weather_forecast in forecasts.items():
+        messages.setdefault(alert_message(weather_forecast), set()).update(subscribers[cell])
+
+    sent = 0
+    batches = 0
+    failed_tokens = []
+    for (title, body), tokens in messages.items():
+        failed_tokens.extend(await run_in_threadpool(send_multicast, list(tokens), title, body))
+        batches += -(-len(tokens) // MULTICAST_LIMIT)
+        sent += len(tokens)
+
+    report = {
+        'duration': round(time.monotonic() - start, 3),
+        'locations': len(locations),
+        'failed_locations': len(locations) - len(forecasts),
+        'upstream_calls': upstream_stats['calls'] - upstream_calls,
+        'notifications': sent,
+        'messages': len(messages),
+        'multicast_batches': batches,
+        'failed_tokens': len(failed_tokens),
+    }
+    print('Weather alert job finished: {0}'.format(report))
+    return report
+
+
+def load_farm_cells(db: Session):
+    """
+        Streams the coordinates of all farms and returns the set of weather grid cells they fall into.
+    """
+    query = db.query(Farms.latitude, Farms.longitude).yield_per(settings.ALERT_YIELD_PER)
+    return {quantize(result.latitude, result.longitude, settings.WEATHER_GRID_SIZE) for result in query}
+
+
+async def refresh_weather_store():
+    """
+        Keeps the stored snapshots of every farm location warm. A snapshot is refreshed when it
+        would expire before the next run, at most WEATHER_REFRESH_CONCURRENCY upstream calls run at once.
+    """
+    start = time.monotonic()
+    upstream_calls = upstream_stats['calls']
+    cells = await run_in_threadpool(run_with_session, load_farm_cells)
+    semaphore = asyncio.Semaphore(settings.WEATHER_REFRESH_CONCURRENCY)
+
+    async def refresh(key):
+        async with semaphore:
+            try:
+                await weather_flight.do(key, lambda: refresh_weather(key))
+            except HTTPException:
+                return False
+            return True
+
+    keys = []
+    for type in WEATHER_TTL:
+        refresh_times = await run_in_threadpool(run_with_session, weather_store.load_refresh_times, type)
+        refresh_before = datetime.datetime.utcnow() - datetime.timedelta(
+            seconds=WEATHER_TTL[type] - settings.WEATHER_REFRESH_INTERVAL)
+        for cell in cells:
+            refresh_time = refresh_times.get(cell_center(cell, settings.WEATHER_GRID_SIZE))
+            if refresh_time is None or refresh_time <= refresh_before:
+                keys.append((type,) + cell)
+
+    results = await asyncio.gather(*[refresh(key) for key in keys])
+    report = {
+        'duration': round(time.monotonic() - start, 3),
+        'locations': len(cells),
+        'refreshed': sum(results),
+        'failed': len(results) - sum(results),
+        'upstream_calls': upstream_stats['calls'] - upstream_calls,
+    }
+    print('Weather refresh job finished: {0}'.format(report))
+    return report
@@ -1,4 +1,5 @@
 import datetime
+import enum
 
 from pydantic import BaseModel
 from typing import Optional
@@ -13,6 +14,12 @@ class GetFeed(BaseModel):
         orm_mode = True
 
 
+class FeedOrder(str, enum.Enum):
+    newest = 'newest'
+    # distance and age mixed into one score
+    nearest_newest = 'nearest_newest'
+
+
 class GetFeedResponse(BaseModel):
     id: int
     user_id: int
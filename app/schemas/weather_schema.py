@@ -75,6 +75,7 @@ class WeatherVariables(BaseModel):
 class CurrentResponse(BaseModel):
     weather: WeatherPydantic
     variables: WeatherVariables
+    stale: bool = False
 
     class Config:
         orm_mode = True
@@ -83,6 +84,7 @@ class CurrentResponse(BaseModel):
 class HourlyResponse(BaseModel):
     weather: WeatherPydantic
     variables: list[WeatherVariables]
+    stale: bool = False
 
     class Config:
         orm_mode = True
@@ -91,6 +93,7 @@ class HourlyResponse(BaseModel):
 class DailyResponse(BaseModel):
     weather: WeatherPydantic
     variables: list[WeatherVariablesDaily]
+    stale: bool = False
 
     class Config:
         orm_mode = True
@@ -106,3 +109,9 @@ class SearchResponse(BaseModel):
 
     class Config:
         orm_mode = True
+
+
+class BulkLocation(BaseModel):
+    id: int
+    latitude: float
+    longitude: float
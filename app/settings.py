@@ -14,6 +14,93 @@ class Settings(BaseSettings):
     REFRESH_TOKEN_EXPIRE_MINUTES: int
     OPENWEATHERMAP_KEY: str
 
+    # weather cache, grid size is in degrees and TTLs are in seconds
+    WEATHER_GRID_SIZE: float = 0.05
+    WEATHER_CACHE_SIZE: int = 4096
+    WEATHER_CURRENT_TTL: int = 600
+    WEATHER_HOURLY_TTL: int = 1800
+    WEATHER_DAILY_TTL: int = 3600
+    # how long expired weather may still be served as stale, and the upstream circuit breaker
+    WEATHER_STALE_TTL: int = 86400
+    WEATHER_BREAKER_FAILURES: int = 5
+    WEATHER_BREAKER_RESET_TIMEOUT: float = 30.0
+    # background refresh of the stored snapshots of farm locations, in seconds
+    WEATHER_REFRESH_INTERVAL: int = 300
+    WEATHER_REFRESH_CONCURRENCY: int = 5
+    # bulk weather endpoint
+    BULK_WEATHER_MAX_LOCATIONS: int = 100
+    BULK_WEATHER_CONCURRENCY: int = 10
+
+    # location search cache, TTL and pacing interval are in seconds
+    SEARCH_CACHE_SIZE: int = 2048
+    SEARCH_CACHE_TTL: int = 86400
+    SEARCH_PREFIX_MIN_LENGTH: int = 3
+    NOMINATIM_MIN_INTERVAL: float = 1.0
+    # results requested from Nominatim per search, its default
+    NOMINATIM_LIMIT: int = 10
+    SEARCH_QUEUE_SIZE: int = 20
+
+    # pooled upstream HTTP clients, timeouts are in seconds
+    HTTP_MAX_CONNECTIONS_PER_HOST: int = 20
+    HTTP_MAX_KEEPALIVE_PER_HOST: int = 10
+    HTTP_KEEPALIVE_EXPIRY: float = 30.0
+    HTTP_CONNECT_TIMEOUT: float = 3.0
+    HTTP_READ_TIMEOUT: float = 10.0
+    HTTP_POOL_TIMEOUT: float = 5.0
+    HTTP_USER_AGENT: str = 'BP_backend/1.0'
+
+    # daily weather alert job, farms closer than the grid size share one forecast
+    ALERT_GRID_SIZE: float = 0.05
+    ALERT_CONCURRENCY: int = 10
+    ALERT_YIELD_PER: int = 1000
+
+    # feed pages, the first page is as long as the former fixed feed
+    FEED_PAGE_SIZE: int = 100
+    FEED_MAX_PAGE_SIZE: int = 100
+    # location feed cache, grid size is in degrees and the TTL in seconds
+    FEED_GRID_SIZE: float = 0.01
+    FEED_CACHE_SIZE: int = 1024
+    FEED_CACHE_TTL: int = 30
+    # candidate posts cached per cell, a cell with more of them is queried for every page
+    FEED_CACHE_MAX_POSTS: int = 1000
+    # nearest_newest ranking, a post this many seconds older ranks like one at the edge of the range
+    FEED_RANK_AGE_SCALE: int = 3 * 86400
+
+    # profile search, trigram matching needs the pg_trgm extension, prefix matching is used without it
+    PROFILE_SEARCH_LIMIT: int = 20
+    PROFILE_SEARCH_MAX_LIMIT: int = 50
+    PROFILE_SEARCH_TRIGRAM: bool = False
+
+    # public part of the profiles, the TTL is in seconds
+    PROFILE_CACHE_SIZE: int = 4096
+    PROFILE_CACHE_TTL: int = 10
+
+    # like counts are changed in place without shards, with shards the changes are collected
+    # in as many rows per profile and flushed into the profile every COUNTER_FLUSH_INTERVAL seconds
+    COUNTER_SHARDS: int = 0
+    COUNTER_FLUSH_INTERVAL: int = 10
+
+    # follower notification outbox, the delays are in seconds and the retry delay doubles on every attempt
+    OUTBOX_DISPATCH_INTERVAL: int = 30
+    OUTBOX_BATCH_SIZE: int = 10
+    OUTBOX_MAX_ATTEMPTS: int = 5
+    OUTBOX_RETRY_DELAY: int = 30
+    OUTBOX_LEASE: int = 300
+
+    # resized variants of the uploaded pictures, sizes are the longest side in pixels
+    IMAGE_THUMB_SIZE: int = 256
+    IMAGE_MEDIUM_SIZE: int = 1024
+    IMAGE_VARIANT_QUALITY: int = 80
+    IMAGE_WORKERS: int = 2
+    IMAGE_MAX_UPLOAD_SIZE: int = 10 * 1024 * 1024
+    # whole multipart request in bytes, a post may upload several photos at once
+    UPLOAD_MAX_BODY_SIZE: int = 50 * 1024 * 1024
+    IMAGE_STORE_DIR: str = 'Images/Store'
+    # in-memory cache of small pictures, sizes in bytes and TTL in seconds
+    IMAGE_CACHE_BYTES: int = 64 * 1024 * 1024
+    IMAGE_CACHE_MAX_ITEM_BYTES: int = 1024 * 1024
+    IMAGE_CACHE_TTL: int = 600
+
     class Config:
         env_file = '.env'
 
@@ -0,0 +1,79 @@
+"""
+    Checks that the circuit breaker of the weather upstream recovers from bad responses. A mocked upstream
+    answers the calls of get_OpenWeather with 503s until the circuit opens, then the half open probe gets
+    a 200 with a body which is not JSON and a later probe a valid response. Exits with 1 when the probe
+    is not reported as an upstream error or the circuit does not close again.
+
+    Run from the repository root:
+        python -m benchmarks.breaker_check
+"""
+import asyncio
+import sys
+
+import httpx
+from fastapi import HTTPException
+
+from app.miscFunctions import http_client
+from app.models import WeatherType
+from app.routers import weather
+from app.routers.weather import get_OpenWeather, weather_breaker, OPENWEATHER_URLS
+from app.miscFunctions.circuit_breaker import CircuitBreaker
+
+LOCATION = (48.1, 17.1)
+
+
+def use_upstream(handler):
+    base_url = OPENWEATHER_URLS[WeatherType.Current][0]
+    http_client._clients[base_url] = httpx.AsyncClient(base_url=base_url, transport=httpx.MockTransport(handler))
+
+
+async def call():
+    try:
+        await get_OpenWeather(*LOCATION)
+        return 200
+    except HTTPException as error:
+        return error.status_code
+
+
+def reopen_after_timeout():
+    weather_breaker.opened_at -= weather_breaker.reset_timeout
+
+
+async def run():
+    results = []
+
+    use_upstream(lambda request: httpx.Response(503))
+    for _ in range(weather_breaker.failure_threshold):
+        await call()
+    results.append(('opened by failures', weather_breaker.state == CircuitBreaker.OPEN))
+
+    reopen_after_timeout()
+    use_upstream(lambda request: httpx.Response(200, text='<html>maintenance</html>'))
+    status_code = await call()
+    results.append(('non JSON probe is an upstream error', status_code == 500))
+    results.append(('non JSON probe opens the circuit',
+                    weather_breaker.state == CircuitBreaker.OPEN and not weather_breaker.probing))
+
+    reopen_after_timeout()
+    use_upstream(lambda request: httpx.Response(200, json={'weather': []}))
+    status_code = await call()
+    results.append(('valid probe closes the circuit',
+                    status_code == 200 and weather_breaker.state == CircuitBreaker.CLOSED))
+
+    use_upstream(lambda request: httpx.Response(200, text='not json'))
+    status_code = await call()
+    results.append(('non JSON response when closed', status_code == 500 and not weather_breaker.probing))
+    await http_client.close_clients()
+    return results
+
+
+def main():
+    results = asyncio.run(run())
+    for name, passed in results:
+        print(f"{name:<40}{'ok' if passed else 'WRONG'}")
+    print(f"upstream calls {weather.upstream_stats['calls']}, errors {weather.upstream_stats['errors']}")
+    sys.exit(0 if all(passed for _, passed in results) else 1)
+
+
+if __name__ == '__main__':
+    main()
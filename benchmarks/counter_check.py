@@ -0,0 +1,130 @@
+"""
+    Fires thousands of concurrent likes, dislikes and posts at one profile through the endpoint functions
+    and checks that its like and post counts match the stored interactions and posts, with the counters
+    changed in place and with sharded counters flushed while the likes arrive. Data is seeded into
+    a scratch schema of the configured database, exits with 1 when a count is wrong.
+
+    Run from the repository root, the argument is the number of followers:
+        python -m benchmarks.counter_check 2000
+"""
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi import BackgroundTasks
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from app.db import init_db
+from app.db.base import Base
+from app.db.migrations import migrate
+from app.miscFunctions.counters import flush_like_counts
+from app.models import Users, Users_attributes, Settings, Interactions, Posts
+from app.routers.feed import new_post
+from app.routers.profile import like_dislike
+from app.schemas.feed_schema import NewPost
+from app.schemas.profile_schema import Like_dislike
+from app.settings import settings
+
+SCHEMA = 'counter_check'
+WORKERS = 32
+POSTS = 500
+FLUSH_INTERVAL = 0.05
+
+
+def seed(session, followers: int):
+    # the users are passed to the endpoints of other sessions
+    with session(expire_on_commit=False) as db:
+        users = [Users(first_name=f'first{i}', last_name=f'last{i}', password='x', email=f'user{i}@check')
+                 for i in range(followers + 1)]
+        db.add_all(users)
+        db.flush()
+        db.add_all([Users_attributes(user_id=user.id) for user in users])
+        db.add_all([Settings(user_id=user.id) for user in users])
+        db.commit()
+        return users[0], users[1:]
+
+
+def run(session, profile, followers: list):
+    def like(follower, interaction):
+        with session() as db:
+            like_dislike(Like_dislike(profile_id=profile.id, interaction=interaction), follower, db)
+
+    def post(number):
+        with session() as db:
+            new_post(NewPost(latitude=48.1, longitude=17.1, category='check', text=str(number)),
+                     BackgroundTasks(), profile, db)
+
+    rng = random.Random(42)
+    # every follower likes the profile, a part of them twice and a part dislikes it again
+    requests = [(like, follower, True) for follower in followers]
+    requests += [(like, follower, True) for follower in rng.sample(followers, len(followers) // 2)]
+    requests += [(like, follower, False) for follower in rng.sample(followers, len(followers) // 4)]
+    requests += [(post, number) for number in range(POSTS)]
+    rng.shuffle(requests)
+    with ThreadPoolExecutor(WORKERS) as executor:
+        for future in [executor.submit(*request) for request in requests]:
+            future.result()
+    return len(requests)
+
+
+def flush_until(session, stop: threading.Event):
+    while not stop.wait(FLUSH_INTERVAL):
+        with session() as db:
+            flush_like_counts(db)
+
+
+def check(session, profile, followers: list, shards: int):
+    settings.COUNTER_SHARDS = shards
+    stop = threading.Event()
+    flusher = threading.Thread(target=flush_until, args=(session, stop))
+    if shards:
+        flusher.start()
+    start = time.perf_counter()
+    count = run(session, profile, followers)
+    elapsed = time.perf_counter() - start
+    if shards:
+        stop.set()
+        flusher.join()
+    with session() as db:
+        flush_like_counts(db)
+        like_count, post_count = db.query(Users_attributes.like_count, Users_attributes.post_count) \
+            .filter(Users_attributes.user_id == profile.id).one()
+        likes = db.query(Interactions).filter(Interactions.followed_profile == profile.id).count()
+        posts = db.query(Posts).filter(Posts.user_id == profile.id).count()
+        # the next mode starts from an empty profile
+        db.query(Interactions).delete()
+        db.query(Posts).delete()
+        db.query(Users_attributes).update({'like_count': 0, 'post_count': 0})
+        db.commit()
+    passed = like_count == likes and post_count == posts
+    print(f"{'shards ' + str(shards) if shards else 'in place':<12}{count:>8} requests {elapsed:>7.2f} s  "
+          f"likes {like_count}/{likes}  posts {post_count}/{posts}  "
+          f"{'ok' if passed else 'WRONG'}")
+    return passed
+
+
+def main():
+    followers = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    engine = create_engine(init_db.database_url, pool_size=WORKERS, max_overflow=0,
+                           connect_args={'options': f'-csearch_path={SCHEMA}'})
+    with engine.connect() as connection:
+        connection.exec_driver_sql(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        connection.exec_driver_sql(f"CREATE SCHEMA {SCHEMA}")
+    try:
+        with engine.connect() as connection:
+            migrate(connection, Base.metadata)
+        session = sessionmaker(autocommit=False, bind=engine)
+        profile, users = seed(session, followers)
+        passed = all([check(session, profile, users, shards) for shards in (0, 16)])
+    finally:
+        with engine.connect() as connection:
+            connection.exec_driver_sql(f"DROP SCHEMA {SCHEMA} CASCADE")
+        engine.dispose()
+    sys.exit(0 if passed else 1)
+
+
+if __name__ == '__main__':
+    main()
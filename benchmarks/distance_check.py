@@ -0,0 +1,76 @@
+"""
+    Checks that the location feed filter selects exactly the posts within the range, for ranges from
+    a few km up to ranges larger than half the circumference of the Earth, which cover the whole globe.
+    Posts are seeded into a scratch schema of the configured database on a grid of the globe, a part of them
+    without stored unit vectors, and the selected posts are compared with their great circle distances.
+    Exits with 1 when they differ.
+
+    Run from the repository root:
+        python -m benchmarks.distance_check
+"""
+import datetime
+import sys
+
+from sqlalchemy.orm import Session
+
+from app.db import init_db
+from app.db.base import Base
+from app.miscFunctions.coordinates import distance, unit_vector
+from app.models import Users, Posts
+from app.routers.feed import distance_filter
+
+SCHEMA = 'distance_check'
+LOCATIONS = [(48.1, 17.1), (-33.9, 151.2), (89.0, 0.0), (0.0, 179.9)]
+RANGES = [10, 500, 5000, 10000, 19000, 20015, 25000, 40000]
+# posts closer to the range than this are left out of the comparison, the stored coordinates are rounded
+TOLERANCE = 1
+
+
+def seed(db: Session):
+    user = Users(first_name='distance', last_name='check', password='x', email='distance@check')
+    db.add(user)
+    db.flush()
+    points = [(latitude, longitude) for latitude in range(-90, 91, 10) for longitude in range(-180, 180, 15)]
+    # the antipodes and close neighbours of the checked locations
+    points += [(-latitude, longitude - 180 if longitude > 0 else longitude + 180) for latitude, longitude in LOCATIONS]
+    points += [(latitude + 0.01, longitude) for latitude, longitude in LOCATIONS if latitude < 89.99]
+    now = datetime.datetime.now()
+    for index, (latitude, longitude) in enumerate(points):
+        # posts of an older worker or not backfilled yet
+        unit_x, unit_y, unit_z = unit_vector(latitude, longitude) if index % 5 else (None, None, None)
+        db.add(Posts(user_id=user.id, latitude=latitude, longitude=longitude, category='check', text='check',
+                     date=now, unit_x=unit_x, unit_y=unit_y, unit_z=unit_z))
+    db.commit()
+
+
+def check(db: Session, location: tuple, distance_range: float):
+    posts = db.query(Posts.id, Posts.latitude, Posts.longitude).all()
+    selected = {post.id for post in db.query(Posts.id).filter(*distance_filter(*location, distance_range))}
+    wrong = [post.id for post in posts
+             if abs(distance(*location, float(post.latitude), float(post.longitude)) - distance_range) > TOLERANCE
+             and (post.id in selected) !=
+             (distance(*location, float(post.latitude), float(post.longitude)) <= distance_range)]
+    print(f"{str(location):<16}{distance_range:>8} km {len(selected):>6} of {len(posts)} posts  "
+          f"{str(len(wrong)) + ' WRONG' if wrong else 'ok'}")
+    return not wrong
+
+
+def main():
+    with init_db.engine.connect() as connection:
+        connection.exec_driver_sql(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        connection.exec_driver_sql(f"CREATE SCHEMA {SCHEMA}")
+        try:
+            connection.exec_driver_sql(f"SET search_path TO {SCHEMA}")
+            Base.metadata.create_all(connection, tables=[Users.__table__, Posts.__table__])
+            with Session(bind=connection) as db:
+                seed(db)
+                passed = all([check(db, location, distance_range)
+                              for location in LOCATIONS for distance_range in RANGES])
+        finally:
+            connection.exec_driver_sql("RESET search_path")
+            connection.exec_driver_sql(f"DROP SCHEMA {SCHEMA} CASCADE")
+    sys.exit(0 if passed else 1)
+
+
+if __name__ == '__main__':
+    main()
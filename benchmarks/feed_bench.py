@@ -0,0 +1,100 @@
+"""
+    Measures the latency of the location feed query with the former full scan acos filter and with
+    the indexed bounding box prefilter. Posts are seeded into a scratch schema of the configured database.
+
+    Run from the repository root, the arguments are the post counts:
+        python -m benchmarks.feed_bench 10000 1000000 10000000
+"""
+import random
+import statistics
+import sys
+import time
+
+from sqlalchemy import func, desc
+from sqlalchemy.orm import Session
+
+from app.db import init_db
+from app.db.base import Base
+from app.models import Users, Posts
+from app.routers.feed import distance_filter
+
+SCHEMA = 'feed_bench'
+USERS = 1000
+# posts are spread over Slovakia
+REGION = ((47.7, 49.6), (16.8, 22.6))
+RUNS = 50
+
+
+def seed(connection, count: int):
+    connection.exec_driver_sql(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+    connection.exec_driver_sql(f"CREATE SCHEMA {SCHEMA}")
+    Base.metadata.create_all(connection, tables=[Users.__table__, Posts.__table__])
+    connection.exec_driver_sql(
+        f"INSERT INTO {SCHEMA}.users (id, first_name, last_name, password, email) "
+        f"SELECT i, 'first' || i, 'last' || i, 'x', 'user' || i || '@bench' FROM generate_series(1, {USERS}) i")
+    (min_lat, max_lat), (min_long, max_long) = REGION
+    connection.exec_driver_sql(
+        f"INSERT INTO {SCHEMA}.posts (user_id, latitude, longitude, category, text, date, unit_x, unit_y, unit_z) "
+        f"SELECT user_id, latitude, longitude, 'crops', 'bench', date, cos(radians(latitude)) * cos(radians(longitude)), "
+        f"cos(radians(latitude)) * sin(radians(longitude)), sin(radians(latitude)) FROM ("
+        f"SELECT 1 + mod(i, {USERS}) AS user_id, {min_lat} + random() * {max_lat - min_lat} AS latitude, "
+        f"{min_long} + random() * {max_long - min_long} AS longitude, "
+        f"now() - random() * interval '365 days' AS date FROM generate_series(1, {count}) i) seeded")
+    connection.exec_driver_sql(f"ANALYZE {SCHEMA}.users")
+    connection.exec_driver_sql(f"ANALYZE {SCHEMA}.posts")
+
+
+def legacy_filter(latitude: float, longitude: float, distance_range: float):
+    # the filter news_feed used before the bounding box prefilter
+    return [func.acos(
+        func.cos(func.radians(latitude)) *
+        func.cos(func.radians(Posts.latitude)) *
+        func.cos(func.radians(Posts.longitude) -
+                 func.radians(longitude)) +
+        func.sin(func.radians(latitude)) *
+        func.sin(func.radians(Posts.latitude))
+    ) * 6371 < distance_range]
+
+
+def feed_query(db: Session, conditions):
+    return db.query(Posts.id, Posts.user_id, Users.first_name, Users.last_name, Posts.latitude,
+                    Posts.longitude, Posts.category, Posts.text, Posts.date) \
+        .join(Users, Users.id == Posts.user_id) \
+        .filter(*conditions) \
+        .order_by(desc(Posts.date)).limit(100).all()
+
+
+def measure(db: Session, build_filter, distance_range: float):
+    rng = random.Random(42)
+    timings = []
+    for _ in range(RUNS):
+        latitude = rng.uniform(*REGION[0])
+        longitude = rng.uniform(*REGION[1])
+        start = time.perf_counter()
+        feed_query(db, build_filter(latitude, longitude, distance_range))
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return statistics.median(timings), timings[int(len(timings) * 0.95) - 1]
+
+
+def main():
+    counts = [int(arg) for arg in sys.argv[1:]] or [10000, 1000000, 10000000]
+    print(f"{'posts':>10}{'range km':>10}{'legacy p50':>12}{'legacy p95':>12}{'bbox p50':>10}{'bbox p95':>10}")
+    for count in counts:
+        with init_db.engine.connect() as connection:
+            connection = connection.execution_options(schema_translate_map={None: SCHEMA})
+            with connection.begin():
+                seed(connection, count)
+            db = Session(bind=connection)
+            for distance_range in (5, 20, 50):
+                legacy = measure(db, legacy_filter, distance_range)
+                bbox = measure(db, distance_filter, distance_range)
+                print(f"{count:>10}{distance_range:>10}{legacy[0]:>12.1f}{legacy[1]:>12.1f}"
+                      f"{bbox[0]:>10.1f}{bbox[1]:>10.1f}")
+            db.close()
+            with connection.begin():
+                connection.exec_driver_sql(f"DROP SCHEMA {SCHEMA} CASCADE")
+
+
+if __name__ == '__main__':
+    main()
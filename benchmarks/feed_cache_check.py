@@ -0,0 +1,117 @@
+"""
+    Checks that the cached location feed returns the same pages as the query at the exact location of the
+    request. Posts are seeded into a scratch schema of the configured database around one grid cell, the feed
+    of random locations inside the cell is paged to the end through the endpoint function, once from the cached
+    candidates of the cell and once with a cell holding too many candidates to be cached.
+    Exits with 1 when a page differs.
+
+    Run from the repository root:
+        python -m benchmarks.feed_cache_check
+"""
+import datetime
+import random
+import sys
+
+from fastapi import HTTPException, Response
+from sqlalchemy.orm import Session
+
+from app.db import init_db
+from app.db.base import Base
+from app.miscFunctions.coordinates import unit_vector, cell_center
+from app.miscFunctions.feed_cache import feed_cache
+from app.models import Users, Posts, Post_photos
+from app.routers.feed import news_feed, load_news_feed, NEXT_CURSOR_HEADER
+from app.schemas.feed_schema import FeedOrder
+from app.settings import settings
+
+SCHEMA = 'feed_cache_check'
+CELL = (4810, 1710)
+POSTS = 1500
+LOCATIONS = 12
+RANGES = [1, 2, 5, 20]
+PAGE_SIZE = 25
+
+
+def seed(db: Session, rng: random.Random):
+    user = Users(first_name='feed', last_name='check', password='x', email='feed@check')
+    db.add(user)
+    db.flush()
+    center_lat, center_long = cell_center(CELL, settings.FEED_GRID_SIZE)
+    now = datetime.datetime.now()
+    for _ in range(POSTS):
+        latitude = center_lat + rng.uniform(-0.1, 0.1)
+        longitude = center_long + rng.uniform(-0.1, 0.1)
+        unit_x, unit_y, unit_z = unit_vector(latitude, longitude)
+        db.add(Posts(user_id=user.id, latitude=latitude, longitude=longitude, category='check', text='check',
+                     date=now - datetime.timedelta(seconds=rng.randrange(7 * 86400)),
+                     unit_x=unit_x, unit_y=unit_y, unit_z=unit_z))
+    db.commit()
+    return user
+
+
+def all_pages(load):
+    pages, cursor = [], None
+    while True:
+        posts, cursor = load(cursor)
+        pages.append([post.id for post in posts])
+        if cursor is None:
+            return pages
+
+
+def endpoint_pages(db: Session, user, location: tuple, distance_range: int, order: FeedOrder):
+    def load(cursor):
+        response = Response()
+        try:
+            posts = news_feed(distance_range, *location, response, PAGE_SIZE, cursor, order, user, db)
+        except HTTPException as error:
+            if error.status_code != 404:
+                raise
+            posts = []
+        return posts, response.headers.get(NEXT_CURSOR_HEADER)
+    return all_pages(load)
+
+
+def exact_pages(db: Session, location: tuple, distance_range: int, order: FeedOrder):
+    return all_pages(lambda cursor: load_news_feed(db, *location, distance_range, PAGE_SIZE, cursor, order))
+
+
+def check(db: Session, user, locations: list, max_posts: int):
+    settings.FEED_CACHE_MAX_POSTS = max_posts
+    wrong = 0
+    for order in FeedOrder:
+        for distance_range in RANGES:
+            feed_cache.clear()
+            for location in locations:
+                wrong += endpoint_pages(db, user, location, distance_range, order) != \
+                         exact_pages(db, location, distance_range, order)
+    print(f"max cached posts {max_posts:<8}{len(locations) * len(RANGES) * len(FeedOrder):>4} feeds  "
+          f"{str(wrong) + ' WRONG' if wrong else 'ok'}")
+    return not wrong
+
+
+def main():
+    rng = random.Random(42)
+    center_lat, center_long = cell_center(CELL, settings.FEED_GRID_SIZE)
+    half = settings.FEED_GRID_SIZE / 2
+    # the corners of the cell and random locations inside it
+    locations = [(center_lat + lat_step * half * 0.999, center_long + long_step * half * 0.999)
+                 for lat_step in (-1, 1) for long_step in (-1, 1)]
+    locations += [(center_lat + rng.uniform(-half, half), center_long + rng.uniform(-half, half))
+                  for _ in range(LOCATIONS - len(locations))]
+    with init_db.engine.connect() as connection:
+        connection.exec_driver_sql(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        connection.exec_driver_sql(f"CREATE SCHEMA {SCHEMA}")
+        try:
+            connection.exec_driver_sql(f"SET search_path TO {SCHEMA}")
+            Base.metadata.create_all(connection, tables=[Users.__table__, Posts.__table__, Post_photos.__table__])
+            with Session(bind=connection) as db:
+                user = seed(db, rng)
+                passed = all([check(db, user, locations, max_posts) for max_posts in (POSTS, 10)])
+        finally:
+            connection.exec_driver_sql("RESET search_path")
+            connection.exec_driver_sql(f"DROP SCHEMA {SCHEMA} CASCADE")
+    sys.exit(0 if passed else 1)
+
+
+if __name__ == '__main__':
+    main()
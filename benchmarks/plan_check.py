@@ -0,0 +1,127 @@
+"""
+    Checks that the main queries of the endpoints are answered with index scans. The schema is created
+    by the migrations in a scratch schema of the configured database, the endpoint functions are called
+    with sequential scans disabled and every query they run is explained. Exits with 1 when a query
+    reads one of the checked tables without an index condition.
+
+    Run from the repository root:
+        python -m benchmarks.plan_check
+"""
+import datetime
+import sys
+
+from fastapi import Response
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from app.db import init_db
+from app.db.base import Base
+from app.db.migrations import migrate
+from app.models import Users, Users_attributes, Settings, Farms, Posts, Post_photos, Interactions
+from app.miscFunctions.coordinates import unit_vector
+from app.routers.farms import get_farm
+from app.routers.feed import load_news_feed, profile_news_feed, news_followers
+from app.routers.profile import get_profile, search_profiles
+from app.routers.register import check_email_is_taken
+from app.routers.settings import get_notifications
+from app.schemas.feed_schema import FeedOrder
+
+SCHEMA = 'plan_check'
+LOCATION = (48.1, 17.1)
+
+# (endpoint, tables which must be read by an index condition, function of (db, user))
+CHECKS = [
+    ('login and registration', {'users'}, lambda db, user: check_email_is_taken(user.email, db)),
+    ('profile search', {'users'}, lambda db, user: search_profiles('Chec', 20, user, db)),
+    ('location feed', {'posts', 'users', 'post_photos'},
+     lambda db, user: load_news_feed(db, *LOCATION, 20, 100, None)),
+    ('location feed nearest_newest', {'posts', 'users', 'post_photos'},
+     lambda db, user: load_news_feed(db, *LOCATION, 20, 100, None, FeedOrder.nearest_newest)),
+    ('profile feed', {'posts', 'users', 'post_photos'},
+     lambda db, user: profile_news_feed(user.id, Response(), 100, None, user, db)),
+    ('profile', {'users', 'users_attributes', 'farms', 'interactions'},
+     lambda db, user: get_profile(user.id, user, db)),
+    ('farms', {'farms'}, lambda db, user: get_farm(user, db)),
+    ('notification settings', {'settings'}, lambda db, user: get_notifications(user, db)),
+    ('news followers', {'interactions', 'settings'}, lambda db, user: news_followers(db, user.id, 0)),
+]
+
+
+def seed(db: Session):
+    user = Users(first_name='plan', last_name='check', password='x', email='plan@check',
+                 search_name='plan check', search_name_reverse='check plan')
+    db.add(user)
+    db.flush()
+    db.add_all([Users_attributes(user_id=user.id), Settings(user_id=user.id, fcm_token='token'),
+                Farms(user_id=user.id, name='farm', latitude=LOCATION[0], longitude=LOCATION[1]),
+                Interactions(follower=user.id, followed_profile=user.id)])
+    unit_x, unit_y, unit_z = unit_vector(*LOCATION)
+    post = Posts(user_id=user.id, latitude=LOCATION[0], longitude=LOCATION[1], category='crops', text='check',
+                 date=datetime.datetime.now(), unit_x=unit_x, unit_y=unit_y, unit_z=unit_z)
+    db.add(post)
+    db.flush()
+    db.add(Post_photos(post_id=post.id, photo='check.png'))
+    db.commit()
+    return user.id
+
+
+def unindexed_scans(plan, tables: set):
+    """
+        Returns the checked tables read by a sequential scan or by a full index scan without an index condition.
+    """
+    found = []
+    if plan.get('Relation Name') in tables and (
+            plan['Node Type'] == 'Seq Scan' or
+            plan['Node Type'] in ('Index Scan', 'Index Only Scan') and 'Index Cond' not in plan):
+        found.append(plan['Relation Name'])
+    for child in plan.get('Plans', []):
+        found.extend(unindexed_scans(child, tables))
+    return found
+
+
+def check(connection, user_id: int, endpoint: str, tables: set, run):
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT'):
+            statements.append((statement, parameters))
+
+    transaction = connection.begin()
+    try:
+        connection.exec_driver_sql('SET LOCAL enable_seqscan = off')
+        db = Session(bind=connection)
+        user = db.query(Users).get(user_id)
+        event.listen(connection, 'before_cursor_execute', capture)
+        try:
+            run(db, user)
+        finally:
+            event.remove(connection, 'before_cursor_execute', capture)
+        scans = []
+        for statement, parameters in statements:
+            plan = connection.exec_driver_sql('EXPLAIN (FORMAT JSON) ' + statement, parameters).scalar()
+            scans.extend(unindexed_scans(plan[0]['Plan'], tables))
+    finally:
+        transaction.rollback()
+    print(f"{endpoint:<32}{len(statements):>4} queries  "
+          f"{'unindexed scan of ' + ', '.join(sorted(set(scans))) if scans else 'ok'}")
+    return not scans
+
+
+def main():
+    with init_db.engine.connect() as connection:
+        connection.exec_driver_sql(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        connection.exec_driver_sql(f"CREATE SCHEMA {SCHEMA}")
+        try:
+            connection.exec_driver_sql(f"SET search_path TO {SCHEMA}")
+            migrate(connection, Base.metadata)
+            with Session(bind=connection) as db:
+                user_id = seed(db)
+            passed = all([check(connection, user_id, *entry) for entry in CHECKS])
+        finally:
+            connection.exec_driver_sql("RESET search_path")
+            connection.exec_driver_sql(f"DROP SCHEMA {SCHEMA} CASCADE")
+    sys.exit(0 if passed else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""
+    Compares the precompiled weather extractors with the former flatten_dict/get_keys_values parsing
+    on recorded OpenWeatherMap payloads.
+
+    Run from the repository root:
+        python -m benchmarks.weather_extract_bench
+"""
+import copy
+import json
+import os
+import timeit
+
+from app.miscFunctions.weather_extract import extract_weather, extract_city, extract_variables, \
+    extract_variables_daily
+from app.schemas.weather_schema import WeatherPydantic, WeatherVariables, WeatherVariablesDaily
+
+PAYLOADS = os.path.join(os.path.dirname(__file__), 'payloads')
+
+
+# former implementation from app/routers/weather.py
+def flatten_dict(d, parent_key='', sep='_'):
+    items = []
+    for k, v in d.items():
+        new_key = parent_key + sep + k if parent_key else k
+        if isinstance(v, list):
+            for elem in v:
+                items.extend(flatten_dict(elem, new_key, sep=sep).items())
+        elif isinstance(v, dict):
+            items.extend(flatten_dict(v, new_key, sep=sep).items())
+        else:
+            items.append((new_key, v))
+    return dict(items)
+
+
+def get_keys_values(variables, key, dict):
+    try:
+        variables[key] = dict.get(key, 0)
+    except Exception:
+        variables[key] = dict.get(key, '')
+    return variables
+
+
+def legacy_curr(data):
+    flattened = flatten_dict(data)
+    weather = {}
+    variables = {}
+    for key in WeatherVariables.__fields__.keys():
+        get_keys_values(variables, key, flattened)
+    for key in WeatherPydantic.__fields__.keys():
+        get_keys_values(weather, key, flattened)
+    return {'weather': weather, 'variables': variables}
+
+
+def legacy_forecast(data, variables_model):
+    weather = {}
+    variables = []
+    for i in range(len(data['list'])):
+        flattened = flatten_dict(data['list'][i])
+        variables.append({})
+        for key in variables_model.__fields__.keys():
+            get_keys_values(variables[i], key, flattened)
+    data['sys'] = data['city']
+    del data['city']
+    flattened = flatten_dict(data)
+    for key in WeatherPydantic.__fields__.keys():
+        get_keys_values(weather, key, flattened)
+    bad_keys = {'sys_name': 'name', 'sys_coord_lat': 'coord_lat',
+                'sys_coord_lon': 'coord_lon', 'sys_timezone': 'timezone'}
+    for key in bad_keys.keys():
+        weather[bad_keys[key]] = flattened.get(key, 0)
+    return {'weather': weather, 'variables': variables}
+
+
+def extract_curr(data):
+    return {'weather': extract_weather(data), 'variables': extract_variables(data)}
+
+
+def extract_forecast(data, extract):
+    return {'weather': extract_city(data), 'variables': [extract(item) for item in data['list']]}
+
+
+def load(name):
+    with open(os.path.join(PAYLOADS, name + '.json')) as file:
+        return json.load(file)
+
+
+def main():
+    current, hourly, daily = load('current'), load('hourly'), load('daily')
+    cases = [
+        ('current', lambda: legacy_curr(current), lambda: extract_curr(current), None),
+        # the legacy parser mutates its input, it gets a fresh copy and the copying time is subtracted
+        ('hourly', lambda: legacy_forecast(copy.deepcopy(hourly), WeatherVariables),
+         lambda: extract_forecast(hourly, extract_variables), lambda: copy.deepcopy(hourly)),
+        ('daily', lambda: legacy_forecast(copy.deepcopy(daily), WeatherVariablesDaily),
+         lambda: extract_forecast(daily, extract_variables_daily), lambda: copy.deepcopy(daily)),
+    ]
+    number = 2000
+    print(f"{'payload':<10}{'legacy us':>12}{'extractor us':>15}{'speedup':>10}")
+    for name, legacy, extractor, setup in cases:
+        assert legacy() == extractor(), f"{name}: extractor result differs from the legacy parser"
+        legacy_time = min(timeit.repeat(legacy, number=number, repeat=5)) / number * 1e6
+        if setup is not None:
+            legacy_time -= min(timeit.repeat(setup, number=number, repeat=5)) / number * 1e6
+        extractor_time = min(timeit.repeat(extractor, number=number, repeat=5)) / number * 1e6
+        print(f"{name:<10}{legacy_time:>12.1f}{extractor_time:>15.1f}{legacy_time / extractor_time:>9.1f}x")
+
+
+if __name__ == '__main__':
+    main()